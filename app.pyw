@@ -14,6 +14,10 @@ from gui import editor, tools, colors
 from core.model import Map, Floor, Room
 
 
+JSON_MAP_FILTER = "Maps (*.gmap *.json)"
+BINARY_MAP_FILTER = "Binary Maps (*.gmap)"
+
+
 def _uniq(seq):
     seen = set()
     ret = []
@@ -48,6 +52,9 @@ class MapDesigner(QMainWindow):
 
         save_action = self.file_menu.addAction("Save", self.save, QKeySequence.Save)
         self.file_menu.addAction("Save As...", self.save_as, QKeySequence("Ctrl+Shift+S"))
+        journal_action = self.file_menu.addAction("Save Changes Only")
+        journal_action.setCheckable(True)
+        journal_action.toggled.connect(self._set_journal_saves)
         self.file_menu.addAction("Exit", self.close, QKeySequence.Quit)
 
         self.edit_menu = self.menu.addMenu("Edit")
@@ -86,6 +93,9 @@ class MapDesigner(QMainWindow):
         if file_to_open:
             self._update_recent_files(file_to_open)
 
+    def _set_journal_saves(self, enabled):
+        self.editor.journal_saves = enabled
+
     def _get_recent_files(self):
         try:
             with open(os.path.join(sys.path[0], '.recent')) as f:
@@ -122,15 +132,18 @@ class MapDesigner(QMainWindow):
             self._update_recent_files(self.editor.filename)
 
     def save_as(self):
-        filename, _ = QFileDialog.getSaveFileName(
+        filename, selected_filter = QFileDialog.getSaveFileName(
             self,
             "Save map as...",
             self.last_dir,
-            "Maps (*.gmap *.json)",
+            ";;".join([JSON_MAP_FILTER, BINARY_MAP_FILTER]),
         )
         if filename:
             self._update_recent_files(filename)
-            self.editor.save(filename)
+            self.editor.save(
+                filename,
+                'binary' if selected_filter == BINARY_MAP_FILTER else 'json'
+            )
         else:
             self.status.showMessage("Save as canceled.")
 
@@ -140,7 +153,7 @@ class MapDesigner(QMainWindow):
                 self,
                 "Open map...",
                 self.last_dir,
-                "Maps (*.gmap *.json)",
+                JSON_MAP_FILTER,
             )
         if filename:
             self._update_recent_files(filename)
@@ -0,0 +1,324 @@
+"""Compact binary map files that can be opened without parsing everything
+
+Layout (all little-endian):
+
+    header      magic, version, floor count, floor table offset,
+                string table offset, settings (JSON string index)
+    floor table (name, room count, room table offset, door count, door table offset)
+                for each floor
+    room table  (id, name, color, bounding box, coordinate type, subpath
+                count, vertex count, offsets offset, coordinates offset,
+                item count, item table offset) for each room of a floor
+    door table  (position, normal, size, room ids, type, notes) for each door
+    item table  (position, label position, label, icon) for each item
+    arrays      subpath offsets and flat vertex coordinates of each room,
+                aligned to 8 bytes so they can be copied straight into `array`s
+    strings     (offset, length) for each UTF-8 string, then the strings
+
+Strings are referred to by their index in the string table, with
+`NO_STRING` standing in for None. Identical strings are only stored once.
+
+Files are memory-mapped when loaded. Each floor is only decoded the
+first time it is accessed, and each room shape the first time it is
+needed, so opening a map takes about the same time regardless of its
+size.
+"""
+
+import argparse
+import functools
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import weakref
+from array import array
+
+from core.geometry import Path, Point, Vector2, path_cache
+from core.model import Door, Floor, Item, LazyFloor, LazyShape, Map, Room
+
+
+MAGIC = b'GMAPBIN\0'
+VERSION = 1
+NO_STRING = 0xFFFFFFFF
+
+HEADER = struct.Struct('<8sIIQQI')
+STRING_ENTRY = struct.Struct('<QI')
+FLOOR_ENTRY = struct.Struct('<IIQIQ')
+ROOM_ENTRY = struct.Struct('<III4dcIIQQIQ')
+DOOR_ENTRY = struct.Struct('<5dIIII')
+ITEM_ENTRY = struct.Struct('<4dII')
+
+# Readers that may still have a file mapped, so it can be released before being overwritten
+_open_readers = weakref.WeakSet()
+
+
+def is_binary(file):
+    """Whether the file is a binary map (as opposed to JSON)"""
+    with open(file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _to_little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class _Writer:
+    def __init__(self):
+        self.data = bytearray(HEADER.size)
+        self.strings = {}
+
+    def string(self, value):
+        if value is None:
+            return NO_STRING
+        return self.strings.setdefault(value, len(self.strings))
+
+    def array(self, values):
+        self.data.extend(bytes(-len(self.data) % 8))
+        position = len(self.data)
+        self.data.extend(_to_little_endian(values).tobytes())
+        return position
+
+    def table(self, entry, rows):
+        position = len(self.data)
+        for row in rows:
+            self.data.extend(entry.pack(*row))
+        return position
+
+    def items(self, items):
+        return self.table(ITEM_ENTRY, [
+            (*item.position, *item.label_pos_hint, self.string(item.label), self.string(item.icon))
+            for item in items
+        ])
+
+    def room(self, room):
+        shape = room.shape
+        return (
+            self.string(room.id),
+            self.string(room.name),
+            self.string(room.color),
+            *shape.bounding_box,
+            shape._coords.typecode.encode(),
+            shape.subpath_count,
+            len(shape._coords) // 2,
+            self.array(shape._offsets),
+            self.array(shape._coords),
+            len(room.items),
+            self.items(room.items),
+        )
+
+    def door(self, door):
+        room_a, room_b = door.room_ids
+        return (
+            *door.position,
+            *door.normal,
+            door.extent * 2,
+            self.string(room_a),
+            self.string(room_b),
+            self.string(door.type),
+            self.string(json.dumps(door.notes)),
+        )
+
+    def floor(self, floor):
+        rooms = [self.room(room) for room in floor.rooms]
+        doors = [self.door(door) for door in floor.doors]
+        return (
+            self.string(floor.name),
+            len(rooms),
+            self.table(ROOM_ENTRY, rooms),
+            len(doors),
+            self.table(DOOR_ENTRY, doors),
+        )
+
+    def finish(self, floor_entries, settings):
+        settings = self.string(json.dumps(settings))
+        floor_table = self.table(FLOOR_ENTRY, floor_entries)
+        encoded = [value.encode('utf-8') for value in self.strings]
+        string_table = len(self.data)
+        position = string_table + len(encoded) * STRING_ENTRY.size
+        for value in encoded:
+            self.data.extend(STRING_ENTRY.pack(position, len(value)))
+            position += len(value)
+        for value in encoded:
+            self.data.extend(value)
+        HEADER.pack_into(
+            self.data, 0,
+            MAGIC, VERSION, len(floor_entries), floor_table, string_table, settings
+        )
+        return self.data
+
+
+def dump(snapshot, f):
+    """Writes a `MapSnapshot` to a file opened in binary mode"""
+    writer = _Writer()
+    floor_entries = []
+    for floor in snapshot.floors:
+        if isinstance(floor, LazyFloor):
+            floor = floor.load().snapshot()
+        floor_entries.append(writer.floor(floor))
+    f.write(writer.finish(floor_entries, snapshot.settings))
+
+
+class _Reader:
+    """Decodes parts of a memory-mapped binary map on request"""
+    def __init__(self, file):
+        self.file = os.path.abspath(file)
+        with open(file, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or not header.startswith(MAGIC):
+                raise ValueError(f"'{file}' is not a binary map")
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            _, version, self.floor_count, self.floor_table, self.string_table, self.settings
+        ) = HEADER.unpack(header)
+        if version > VERSION:
+            raise ValueError(f"'{file}' was saved by a newer version (format {version})")
+        self._strings = {}
+        # Floors can be decoded by a background save while the file is being detached
+        self._lock = threading.RLock()
+        _open_readers.add(self)
+
+    def detach(self):
+        """Copies the file into memory and unmaps it, so the file can be safely overwritten"""
+        with self._lock:
+            if isinstance(self.buffer, mmap.mmap):
+                mapped = self.buffer
+                self.buffer = mapped[:]
+                mapped.close()
+
+    def string(self, index):
+        if index == NO_STRING:
+            return None
+        if index not in self._strings:
+            position, length = STRING_ENTRY.unpack_from(
+                self.buffer, self.string_table + index * STRING_ENTRY.size
+            )
+            self._strings[index] = self.buffer[position:position + length].decode('utf-8')
+        return self._strings[index]
+
+    def array(self, typecode, position, count):
+        values = array(typecode)
+        values.frombytes(self.buffer[position:position + count * values.itemsize])
+        return _to_little_endian(values)
+
+    def shape(self, typecode, subpath_count, vertex_count, offsets, coords):
+        with self._lock:
+            return path_cache.intern(Path._from_flat(
+                self.array(typecode, coords, 2 * vertex_count),
+                self.array('q', offsets, subpath_count + 1),
+            ))
+
+    def items(self, count, position):
+        items = []
+        for i in range(count):
+            x, y, hint_x, hint_y, label, icon = ITEM_ENTRY.unpack_from(
+                self.buffer, position + i * ITEM_ENTRY.size
+            )
+            items.append(
+                Item(Point(x, y), self.string(label), Point(hint_x, hint_y), self.string(icon))
+            )
+        return items
+
+    def room(self, position):
+        (
+            id, name, color,
+            minx, miny, maxx, maxy,
+            typecode, subpath_count, vertex_count, offsets, coords,
+            item_count, items,
+        ) = ROOM_ENTRY.unpack_from(self.buffer, position)
+        typecode = typecode.decode()
+        bounding_box = (minx, miny, maxx, maxy)
+        if typecode == 'q':
+            bounding_box = tuple(int(value) for value in bounding_box)
+        room = Room(
+            LazyShape(
+                functools.partial(
+                    self.shape, typecode, subpath_count, vertex_count, offsets, coords
+                ),
+                bounding_box,
+            ),
+            self.string(name),
+            self.string(color),
+            self.items(item_count, items),
+        )
+        room._id = self.string(id)
+        return room
+
+    def door(self, position, rooms_by_id):
+        x, y, normal_x, normal_y, size, room_a, room_b, type, notes = DOOR_ENTRY.unpack_from(
+            self.buffer, position
+        )
+        return Door(
+            Point(x, y),
+            Vector2(normal_x, normal_y),
+            (rooms_by_id.get(self.string(room_a)), rooms_by_id.get(self.string(room_b))),
+            size,
+            self.string(type),
+            json.loads(self.string(notes)),
+        )
+
+    def floor(self, index):
+        with self._lock:
+            name, room_count, room_table, door_count, door_table = FLOOR_ENTRY.unpack_from(
+                self.buffer, self.floor_table + index * FLOOR_ENTRY.size
+            )
+            floor = Floor(
+                [self.room(room_table + i * ROOM_ENTRY.size) for i in range(room_count)],
+                name=self.string(name)
+            )
+            floor._load_doors(
+                self.door(door_table + i * DOOR_ENTRY.size, floor._rooms_by_id)
+                for i in range(door_count)
+            )
+            return floor
+
+
+def release(file):
+    """Unmaps the file from any maps loaded from it, so it can be overwritten
+
+    Only Windows needs this, as it won't replace a file that is mapped.
+    Elsewhere, saving renames the new file over the old one, and the old
+    file's data stays readable through the mapping until it is closed.
+    """
+    if os.name != 'nt' or not os.path.exists(file):
+        return
+    for reader in list(_open_readers):
+        if os.path.exists(reader.file) and os.path.samefile(reader.file, file):
+            reader.detach()
+
+
+def load(file):
+    """Opens a binary map. Floors and room shapes are decoded the first time they are used."""
+    reader = _Reader(file)
+    floors = [LazyFloor(functools.partial(reader.floor, i)) for i in range(reader.floor_count)]
+    map = Map(floors, **json.loads(reader.string(reader.settings)))
+    map.format = 'binary'
+    return map
+
+
+def convert(source, destination, format=None):
+    """Converts a map file between JSON and binary. By default, to whichever it isn't."""
+    if format is None:
+        format = 'json' if is_binary(source) else 'binary'
+    Map.load(source).save(destination, format)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert maps between JSON and binary")
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    parser.add_argument(
+        '--to',
+        choices=['json', 'binary'],
+        help="output format (defaults to the opposite of the source's format)"
+    )
+    args = parser.parse_args()
+    convert(args.source, args.destination, args.to)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Cell occupancy bitmaps for grid-aligned room shapes
+
+Each row of cells is packed into a single Python int, so boolean
+operations between shapes cost one big-int operation per row instead of
+a polygon boolean over every vertex. Point tests and splitting into
+connected parts also work on the rows directly, so the outline is only
+traced back into a `Path` when it is asked for (to paint or save it).
+"""
+
+import math
+
+from core import rectilinear
+from core.geometry import Path
+
+
+def _runs(mask):
+    """Yields (start, end) bit index pairs for each run of set bits"""
+    x = 0
+    while mask:
+        zeros = (mask & -mask).bit_length() - 1
+        mask >>= zeros
+        x += zeros
+        ones = (mask ^ (mask + 1)).bit_length() - 1
+        yield x, x + ones
+        mask >>= ones
+        x += ones
+
+
+class CellBitmap:
+    """Set of unit grid cells. Cell (x, y) covers the square from (x, y) to (x + 1, y + 1).
+
+    Rows are stored as {y: mask}, where bit i of a mask is cell x0 + i.
+    """
+    def __init__(self, rows=(), x0=0):
+        self._rows = {y: mask for y, mask in dict(rows).items() if mask}
+        self._x0 = x0
+        self._bounding_box = None
+
+    @classmethod
+    def from_path(cls, path):
+        if not path.is_grid_aligned:
+            raise ValueError("Only grid-aligned paths can be converted to cell bitmaps")
+        rings = path._rings()
+        x0 = path.bounding_box[0]
+        ys = sorted({y for ring in rings for _, y in ring})
+        rows = {}
+        for y0, y1, intervals in zip(ys, ys[1:], rectilinear.slab_coverage(rings, ys)):
+            mask = 0
+            for start, end in intervals:
+                mask |= ((1 << (end - start)) - 1) << (start - x0)
+            if mask:
+                for y in range(y0, y1):
+                    rows[y] = mask
+        return cls(rows, x0)
+
+    @classmethod
+    def from_cells(cls, cells):
+        cells = list(cells)
+        if not cells:
+            return cls()
+        x0 = min(x for x, _ in cells)
+        rows = {}
+        for x, y in cells:
+            rows[y] = rows.get(y, 0) | (1 << (x - x0))
+        return cls(rows, x0)
+
+    def __bool__(self):
+        return bool(self._rows)
+
+    def __eq__(self, other):
+        if not isinstance(other, CellBitmap):
+            return NotImplemented
+        x0, rows_a, rows_b = self._aligned(other)
+        return rows_a == rows_b
+
+    def __contains__(self, point):
+        """Same as `point in self.to_path()`
+
+        Like the raycast there, a cell holds the points from its top edge
+        down to (but not including) its bottom edge, and from just right
+        of its left edge up to and including its right edge.
+        """
+        x, y = point
+        column = math.ceil(x) - 1 - self._x0
+        return column >= 0 and bool(self._rows.get(math.floor(y), 0) >> column & 1)
+
+    def contains_many(self, points):
+        """Batched `in` test. Returns a list of bools, one for each point."""
+        return [point in self for point in points]
+
+    def __len__(self):
+        return sum(bin(mask).count('1') for mask in self._rows.values())
+
+    def _aligned(self, other):
+        """Both bitmaps' rows, shifted to a common x0"""
+        x0 = min(self._x0, other._x0)
+        shift_a = self._x0 - x0
+        shift_b = other._x0 - x0
+        return (
+            x0,
+            {y: mask << shift_a for y, mask in self._rows.items()},
+            {y: mask << shift_b for y, mask in other._rows.items()},
+        )
+
+    def union(self, other):
+        x0, a, b = self._aligned(other)
+        for y, mask in b.items():
+            a[y] = a.get(y, 0) | mask
+        return self.__class__(a, x0)
+
+    def intersection(self, other):
+        x0, a, b = self._aligned(other)
+        return self.__class__({y: a[y] & b[y] for y in a.keys() & b.keys()}, x0)
+
+    def difference(self, other):
+        x0, a, b = self._aligned(other)
+        return self.__class__({y: mask & ~b.get(y, 0) for y, mask in a.items()}, x0)
+
+    def intersects(self, other):
+        x0, a, b = self._aligned(other)
+        return any(a[y] & b[y] for y in a.keys() & b.keys())
+
+    __or__ = __add__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    @property
+    def bounding_box(self):
+        if not self._rows:
+            return None
+        if self._bounding_box is None:
+            masks = self._rows.values()
+            self._bounding_box = (
+                self._x0 + min((mask & -mask).bit_length() - 1 for mask in masks),
+                min(self._rows),
+                self._x0 + max(mask.bit_length() for mask in masks),
+                max(self._rows) + 1,
+            )
+        return self._bounding_box
+
+    def _slabs(self):
+        """(y0, y1, mask) for each run of identical rows, top to bottom"""
+        slabs = []
+        for y in sorted(self._rows):
+            mask = self._rows[y]
+            if slabs and slabs[-1][1] == y and slabs[-1][2] == mask:
+                slabs[-1][1] = y + 1
+            else:
+                slabs.append([y, y + 1, mask])
+        return slabs
+
+    def components(self):
+        """Splits the cells into their edge-connected parts
+
+        Parts are ordered by their top-left-most cell, which is the order
+        `Path.shapes()` gives them in for the traced outline. Identical rows
+        are handled together, so a tall part costs no more than a short one.
+        """
+        runs = []  # (slab index, start, end) of each run of cells, top to bottom
+        parent = []
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        slabs = self._slabs()
+        above = []
+        above_y1 = None
+        for k, (y0, y1, mask) in enumerate(slabs):
+            row = []
+            for start, end in _runs(mask):
+                row.append(len(runs))
+                parent.append(len(runs))
+                runs.append((k, start, end))
+            if above_y1 == y0:
+                # Join runs that share an edge with a run in the slab above
+                i = j = 0
+                while i < len(above) and j < len(row):
+                    _, start_a, end_a = runs[above[i]]
+                    _, start_b, end_b = runs[row[j]]
+                    if start_a < end_b and start_b < end_a:
+                        parent[find(row[j])] = find(above[i])
+                    if end_a < end_b:
+                        i += 1
+                    else:
+                        j += 1
+            above = row
+            above_y1 = y1
+
+        if len({find(i) for i in range(len(runs))}) <= 1:
+            return [self] if runs else []
+        parts = {}
+        for i, (k, start, end) in enumerate(runs):
+            masks = parts.setdefault(find(i), {})
+            masks[k] = masks.get(k, 0) | ((1 << (end - start)) - 1) << start
+        return [
+            self.__class__(
+                {y: mask for k, mask in masks.items() for y in range(*slabs[k][:2])},
+                self._x0,
+            )
+            for masks in parts.values()
+        ]
+
+    def to_path(self):
+        """Traces the outline of the cells. Returns None if there are none."""
+        slabs = []
+        for y0, y1, mask in self._slabs():
+            if slabs and slabs[-1][1] != y0:
+                slabs.append((slabs[-1][1], y0, []))  # outline tracing needs contiguous slabs
+            slabs.append((y0, y1, [
+                (self._x0 + start, self._x0 + end) for start, end in _runs(mask)
+            ]))
+        rings = rectilinear.outline(slabs)
+        return Path(*rings).normalized() if rings else None
+
+    def to_json(self):
+        """Runs of identical rows as [y, height, mask in hex], along with x0"""
+        return {
+            'x0': self._x0,
+            'rows': [[y0, y1 - y0, f'{mask:x}'] for y0, y1, mask in self._slabs()],
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        rows = {}
+        for y, height, mask in data['rows']:
+            mask = int(mask, 16)
+            for row in range(y, y + height):
+                rows[row] = mask
+        return cls(rows, data['x0'])
@@ -1,12 +1,20 @@
 """All classes and utility functions for defining room geometry
+
+This module does not depend on Qt. PySide2 is only imported on demand
+when a `QPainterPath` is requested for drawing, or when a boolean
+operation involves a non-rectilinear path.
 """
 
+import hashlib
 import math
-import itertools
-from collections import namedtuple
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
 from enum import Enum
 
-from PySide2.QtGui import QPainterPath
+from core import rectilinear
+from core.spatial import GridIndex
 
 
 class Vector2(namedtuple('_Vector2', ['x', 'y'])):
@@ -129,105 +137,450 @@ def _point_of_intersection(p11, p12, p21, p22):
     else:
         return None
 
-def _x_at_y(p1, p2, y):
-    vec = p2 - p1
-    dy = y - p1.y
-    return p1.x + (dy / vec.y) * vec.x
+def _flat_contains(coords, offsets, first, last, x, y):
+    """Odd-even horizontal raycast to the left against subpaths `first` to `last - 1`
 
-def _left_raycast(p1, p2, point):
+    Works directly on the flat coordinate buffer of a `Path`. Each edge
+    spans the half-open range of y from its lower end up to, but not
+    including, its upper end, so a ray through a vertex is counted once.
+    """
     point_inside = False
-    if p1.y == p2.y or point.x < p1.x and point.x < p2.x:
-        return False # ignore horizontal lines and degenerate segments
-    miny = min(p1.y, p2.y)
-    maxy = max(p1.y, p2.y)
-    if point.y < miny or point.y > maxy:
-        return False
-    maxx = max(p1.x, p2.x)
-    return point.x > maxx or point.x > _x_at_y(p1, p2, point.y)
+    for k in range(first, last):
+        start = 2 * offsets[k]
+        end = 2 * offsets[k + 1]
+        x1 = coords[end - 2]
+        y1 = coords[end - 1]
+        for i in range(start, end, 2):
+            x2 = coords[i]
+            y2 = coords[i + 1]
+            # ignore horizontal lines and segments entirely to the right
+            if (x >= x1 or x >= x2) and (y1 <= y < y2 or y2 <= y < y1):
+                if x > x1 and x > x2 or x > x1 + (y - y1) / (y2 - y1) * (x2 - x1):
+                    point_inside = not point_inside
+            x1 = x2
+            y1 = y2
+    return point_inside
 
-def _polygon_contains(polygon, point):
+def _build_edge_table(coords, offsets):
+    """Buckets the non-horizontal edges by the horizontal slabs they cross
+
+    Returns `(ys, edges, slabs)`, where `ys` are the sorted distinct vertex
+    y coordinates, `edges` are (x1, y1, x2, y2) tuples, and `slabs[j]` holds
+    the indices of the edges crossing the slab between `ys[j]` and `ys[j + 1]`.
+    """
+    edges = []
+    for k in range(len(offsets) - 1):
+        start = 2 * offsets[k]
+        end = 2 * offsets[k + 1]
+        x1 = coords[end - 2]
+        y1 = coords[end - 1]
+        for i in range(start, end, 2):
+            x2 = coords[i]
+            y2 = coords[i + 1]
+            if y1 != y2:
+                edges.append((x1, y1, x2, y2))
+            x1 = x2
+            y1 = y2
+    ys = sorted(set(coords[1::2]))
+    by_bottom = sorted(range(len(edges)), key=lambda e: min(edges[e][1], edges[e][3]))
+    slabs = []
+    active = []
+    next_edge = 0
+    for y in ys[:-1]:
+        while (
+            next_edge < len(by_bottom)
+            and min(edges[by_bottom[next_edge]][1], edges[by_bottom[next_edge]][3]) <= y
+        ):
+            active.append(by_bottom[next_edge])
+            next_edge += 1
+        active = [e for e in active if max(edges[e][1], edges[e][3]) > y]
+        slabs.append(tuple(active))
+    return ys, edges, slabs
+
+def _edge_table_contains(table, x, y):
+    """Same as `_flat_contains`, but only looks at the edges crossing y"""
+    ys, edges, slabs = table
+    j = bisect_right(ys, y) - 1
+    if j < 0 or j == len(slabs):
+        return False
     point_inside = False
-    for p1, p2 in polygon:
-        if _left_raycast(p1, p2, point):
+    for e in slabs[j]:
+        x1, y1, x2, y2 = edges[e]
+        if (x >= x1 or x >= x2) and (
+            x > x1 and x > x2 or x > x1 + (y - y1) / (y2 - y1) * (x2 - x1)
+        ):
             point_inside = not point_inside
     return point_inside
 
+def _edge_table_contains_many(table, points):
+    """Batched `_edge_table_contains`
+
+    A point crosses every vertical edge of its slab that is to its left,
+    so those are counted with a binary search over their sorted xs rather
+    than visited one by one. Each slab's edges are only sorted the first
+    time a point falls within it.
+    """
+    slab_ys, edges, slabs = table
+    split_slabs = {}
+    result = []
+    for x, y in points:
+        j = bisect_right(slab_ys, y) - 1
+        if j < 0 or j == len(slabs):
+            result.append(False)
+            continue
+        split = split_slabs.get(j)
+        if split is None:
+            vertical_xs = []
+            other = []
+            for e in slabs[j]:
+                x1, y1, x2, y2 = edges[e]
+                if x1 == x2:
+                    vertical_xs.append(x1)
+                else:
+                    other.append(edges[e])
+            vertical_xs.sort()
+            split = split_slabs[j] = vertical_xs, other
+        vertical_xs, other = split
+        point_inside = bisect_left(vertical_xs, x) % 2 == 1
+        for x1, y1, x2, y2 in other:
+            if (x >= x1 or x >= x2) and (
+                x > x1 and x > x2 or x > x1 + (y - y1) / (y2 - y1) * (x2 - x1)
+            ):
+                point_inside = not point_inside
+        result.append(point_inside)
+    return result
+
+COLLINEAR_EPSILON = 1e-9
+
+# Paths with fewer edges than this are cheaper to scan than to index
+EDGE_TABLE_MIN_EDGES = 32
+# ...unless at least this many points are tested at once
+EDGE_TABLE_MIN_POINTS = 4
+
+# Default cap on the total number of vertices of all paths kept by a `PathCache`
+PATH_CACHE_MAX_VERTICES = 1024 * 1024
+
+def _collinear(a, b, c):
+    abx = b[0] - a[0]
+    aby = b[1] - a[1]
+    bcx = c[0] - b[0]
+    bcy = c[1] - b[1]
+    scale = (abs(abx) + abs(aby)) * (abs(bcx) + abs(bcy))
+    return abs(abx * bcy - aby * bcx) <= COLLINEAR_EPSILON * scale
+
+def _exact(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    else:
+        return value
+
+def _simplify_ring(ring):
+    """Removes zero-length edges and merges collinear runs of a closed ring"""
+    points = []
+    for x, y in ring:
+        point = (_exact(x), _exact(y))
+        if points and points[-1] == point:
+            continue
+        while len(points) >= 2 and _collinear(points[-2], points[-1], point):
+            points.pop()
+        points.append(point)
+    while len(points) >= 3:
+        if points[-1] == points[0] or _collinear(points[-2], points[-1], points[0]):
+            points.pop()
+        elif _collinear(points[-1], points[0], points[1]):
+            points.pop(0)
+        else:
+            break
+    return points if len(points) >= 3 else None
+
+def _signed_area2(ring):
+    """Twice the signed area. Positive is clockwise on screen (y pointing down)."""
+    x1, y1 = ring[-1]
+    area = 0
+    for x2, y2 in ring:
+        area += x1 * y2 - x2 * y1
+        x1 = x2
+        y1 = y2
+    return area
+
+def _canonical_start(ring):
+    start = min(range(len(ring)), key=lambda i: (ring[i][1], ring[i][0]))
+    return ring[start:] + ring[:start]
+
+def _coord_array(values):
+    """Packs coordinates into a typed buffer, keeping integers as integers"""
+    values = list(values)
+    if all(type(v) is int for v in values):
+        return array('q', values)
+    else:
+        return array('d', values)
+
 class Path:
     """Representation of the shape of a room. Pseudo-immutable.
+
+    Vertices are stored flat as [x0, y0, x1, y1, ...] in a typed array,
+    with `_offsets[i]` being the index of the first vertex of subpath i
+    (plus a trailing end offset).
     """
     def __init__(self, *subpaths):
-        self._subpaths = [
-            [Point(*p) for p in subpath]
-            for subpath in subpaths
-        ]
+        coords = []
+        offsets = [0]
+        for subpath in subpaths:
+            for x, y in subpath:
+                coords.append(x)
+                coords.append(y)
+            offsets.append(len(coords) // 2)
+        self._coords = _coord_array(coords)
+        self._offsets = array('q', offsets)
+        self._reset_caches()
+
+    @classmethod
+    def _from_flat(cls, coords, offsets):
+        path = cls.__new__(cls)
+        path._coords = coords
+        path._offsets = offsets
+        path._reset_caches()
+        return path
+
+    def _reset_caches(self):
         self._bounding_box = None
         self._qpath = None
+        self._is_rectilinear = None
+        self._edge_table = None
+
+    @property
+    def subpath_count(self):
+        return len(self._offsets) - 1
+
+    def _subpath_range(self, which):
+        if which is Ellipsis:
+            return range(self.subpath_count)
+        else:
+            return range(self.subpath_count)[which:which + 1 or None]
+
+    def _rings(self):
+        """Subpaths as lists of plain (x, y) tuples"""
+        coords = self._coords
+        offsets = self._offsets
+        return [
+            list(zip(
+                coords[2 * offsets[k]:2 * offsets[k + 1]:2],
+                coords[2 * offsets[k] + 1:2 * offsets[k + 1]:2],
+            ))
+            for k in range(self.subpath_count)
+        ]
+
+    def _select(self, which):
+        """New path made of only the given subpaths"""
+        coords = array(self._coords.typecode)
+        offsets = array('q', [0])
+        for k in which:
+            coords.extend(self._coords[2 * self._offsets[k]:2 * self._offsets[k + 1]])
+            offsets.append(len(coords) // 2)
+        return self._from_flat(coords, offsets)
 
     # -- Geometric operations --
 
     @property
     def bounding_box(self):
         if self._bounding_box is None:
-            all_x, all_y = zip(*self.points())
+            all_x = self._coords[0::2]
+            all_y = self._coords[1::2]
             self._bounding_box = min(all_x), min(all_y), max(all_x), max(all_y)
         return self._bounding_box
 
+    def _subpath_area(self, k):
+        coords = self._coords
+        start = 2 * self._offsets[k]
+        end = 2 * self._offsets[k + 1]
+        x1 = coords[end - 2]
+        y1 = coords[end - 1]
+        area = 0
+        for i in range(start, end, 2):
+            x2 = coords[i]
+            y2 = coords[i + 1]
+            area += x1 * y2 - x2 * y1
+            x1 = x2
+            y1 = y2
+        return abs(area) / 2
+
+    def _subpath_bounding_box(self, k):
+        start = 2 * self._offsets[k]
+        end = 2 * self._offsets[k + 1]
+        all_x = self._coords[start:end:2]
+        all_y = self._coords[start + 1:end:2]
+        return min(all_x), min(all_y), max(all_x), max(all_y)
+
+    def nesting(self):
+        """The containment tree of the subpaths
+
+        Returns a `(parent, depth)` pair for each subpath, where `parent`
+        is the index of the innermost subpath containing it (or None) and
+        `depth` is how many subpaths contain it. Even depths are outer
+        boundaries and odd depths are holes.
+
+        A hole whose top edge is level with a corner of the outer boundary
+        is still a hole:
+
+        >>> room = Path.from_rect(0, 0, 10, 10) - Path.from_rect(0, 0, 3, 3)
+        >>> (room - Path.from_rect(5, 3, 1, 1)).nesting()
+        [(None, 0), (0, 1)]
+        """
+        coords = self._coords
+        offsets = self._offsets
+        areas = [self._subpath_area(k) for k in range(self.subpath_count)]
+        # A subpath can only be contained by one with a larger area,
+        # so every potential parent is indexed before its children.
+        index = GridIndex()
+        result = [None] * self.subpath_count
+        for k in sorted(range(self.subpath_count), key=lambda k: -areas[k]):
+            # Test with the midpoint of the first edge. Vertices can touch other subpaths.
+            i = 2 * offsets[k]
+            x = (coords[i] + coords[i + 2]) / 2
+            y = (coords[i + 1] + coords[i + 3]) / 2
+            parent = min(
+                (
+                    candidate for candidate in index.query_point((x, y))
+                    if _flat_contains(coords, offsets, candidate, candidate + 1, x, y)
+                ),
+                key=lambda candidate: areas[candidate],
+                default=None,
+            )
+            result[k] = (parent, 0 if parent is None else result[parent][1] + 1)
+            index.insert(k, self._subpath_bounding_box(k))
+        return result
+
     def shapes(self):
-        shapes = [[0]]
-        for i in range(1, len(self._subpaths)):
-            for shape in shapes:
-                if _polygon_contains(self.segments(shape[0]), self._subpaths[i][0]):
-                    shape.append(i)
-                    break
+        """Splits the path into its disconnected parts, each with its own holes"""
+        shapes = {}
+        for k, (parent, depth) in enumerate(self.nesting()):
+            if depth % 2 == 0:
+                shapes.setdefault(k, []).insert(0, k)
             else:
-                shapes.append([i])
-        return [
-            self.__class__(*[self._subpaths[path] for path in shape])
-            for shape in shapes
-        ]
+                shapes.setdefault(parent, []).append(k)
+        return [self._select(shapes[k]) for k in sorted(shapes)]
 
     def segments(self, which=Ellipsis):
-        if which is Ellipsis:
-            for subpath in self._subpaths:
-                l = len(subpath)
-                for i in range(l):
-                    yield (subpath[i], subpath[(i + 1) % l])
-        else:
-            subpath = self._subpaths[which]
-            l = len(subpath)
-            for i in range(l):
-                yield (subpath[i], subpath[(i + 1) % l])
+        for k in self._subpath_range(which):
+            ring = list(self.points(k))
+            yield from zip(ring, ring[1:] + ring[:1])
 
     def points(self, which=Ellipsis):
-        if which is Ellipsis:
-            yield from itertools.chain.from_iterable(self._subpaths)
-        else:
-            yield from self._subpaths[which]
+        coords = self._coords
+        offsets = self._offsets
+        for k in self._subpath_range(which):
+            for i in range(2 * offsets[k], 2 * offsets[k + 1], 2):
+                yield Point(coords[i], coords[i + 1])
 
     def __contains__(self, point):
         """Exclusive point membership test - does not count colinear points or segments
 
         Uses odd-even rule with a horizontal raycast to the left
         """
+        x, y = point
         minx, miny, maxx, maxy = self.bounding_box
-        if point.x < minx or point.x > maxx or point.y < miny or point.y > maxy:
+        if x < minx or x > maxx or y < miny or y > maxy:
             return False
-        return _polygon_contains(self.segments(), point)
+        if len(self._coords) < 2 * EDGE_TABLE_MIN_EDGES:
+            return _flat_contains(self._coords, self._offsets, 0, self.subpath_count, x, y)
+        return _edge_table_contains(self._get_edge_table(), x, y)
+
+    def _get_edge_table(self):
+        if self._edge_table is None:
+            self._edge_table = _build_edge_table(self._coords, self._offsets)
+        return self._edge_table
+
+    def contains_many(self, points):
+        """Batched `in` test. Returns a list of bools, one for each point.
+
+        Equivalent to `[p in self for p in points]`, but goes through the
+        edge table, which pays for itself over a batch of a few points even
+        for paths too small to be worth it for a single point.
+        """
+        if not points:
+            return []
+        if (
+            self._edge_table is None
+            and len(points) < EDGE_TABLE_MIN_POINTS
+            and len(self._coords) < 2 * EDGE_TABLE_MIN_EDGES
+        ):
+            return [point in self for point in points]
+        return _edge_table_contains_many(self._get_edge_table(), points)
+
+    @property
+    def is_grid_aligned(self):
+        """Whether the path is made of whole grid cells (rectilinear with integer coordinates)"""
+        return self._coords.typecode == 'q' and self.is_rectilinear
+
+    @property
+    def is_rectilinear(self):
+        """Whether every edge is axis-aligned, allowing for exact boolean operations"""
+        if self._is_rectilinear is None:
+            self._is_rectilinear = rectilinear.is_rectilinear(self._rings())
+        return self._is_rectilinear
+
+    def _from_rings(self, rings):
+        return self.__class__(*rings).normalized() if rings else None
+
+    def normalized(self):
+        """Canonical form of the path, or None if nothing of it has any area
+
+        Zero-length edges and collinear vertices are removed, outer
+        boundaries wind clockwise on screen and holes counter-clockwise,
+        and each subpath starts at its top-left-most vertex. Integral float
+        coordinates become ints. Applied after every boolean operation so
+        that vertex counts track the actual shape rather than its history.
+        """
+        rings = [ring for ring in map(_simplify_ring, self._rings()) if ring]
+        if not rings:
+            return None
+        simplified = self.__class__(*rings)
+        for k, (_, depth) in enumerate(simplified.nesting()):
+            is_hole = depth % 2 == 1
+            if (_signed_area2(rings[k]) < 0) != is_hole:
+                rings[k].reverse()
+            rings[k] = _canonical_start(rings[k])
+        return self.__class__(*rings)
 
     def union(self, other):
+        if self.is_rectilinear and other.is_rectilinear:
+            return self._from_rings(rectilinear.union(self._rings(), other._rings()))
         return self.from_qpath(self.qpath | other.qpath)
 
     def intersection(self, other):
+        if self.is_rectilinear and other.is_rectilinear:
+            return self._from_rings(rectilinear.intersection(self._rings(), other._rings()))
         return self.from_qpath(self.qpath & other.qpath)
 
     def difference(self, other):
+        if self.is_rectilinear and other.is_rectilinear:
+            return self._from_rings(rectilinear.difference(self._rings(), other._rings()))
         return self.from_qpath(self.qpath - other.qpath)
 
+    @classmethod
+    def union_all(cls, paths):
+        """Union of any number of paths, or None if there are none
+
+        Paths are merged pairwise as a balanced tree, so each vertex takes
+        part in O(log n) boolean operations rather than one per path.
+        """
+        paths = [path for path in paths if path is not None]
+        if not paths:
+            return None
+        while len(paths) > 1:
+            merged = [a | b for a, b in zip(paths[0::2], paths[1::2])]
+            if len(paths) % 2:
+                merged.append(paths[-1])
+            paths = merged
+        return paths[0]
+
     def intersects(self, other):
         s_minx, s_miny, s_maxx, s_maxy = self.bounding_box
         o_minx, o_miny, o_maxx, o_maxy = other.bounding_box
         if s_minx >= o_maxx or s_miny >= o_maxy or s_maxx <= o_minx or s_maxy <= o_miny:
             return False
+        elif self.is_rectilinear and other.is_rectilinear:
+            return rectilinear.overlaps(self._rings(), other._rings())
         else:
             return self.qpath.intersects(other.qpath)
 
@@ -240,10 +593,12 @@ class Path:
     @property
     def qpath(self):
         if self._qpath is None:
+            from PySide2.QtGui import QPainterPath
             self._qpath = QPainterPath()
-            for subpath in self._subpaths:
-                self._qpath.moveTo(*subpath[0])
-                for point in subpath[1:]:
+            for k in range(self.subpath_count):
+                first, *rest = self.points(k)
+                self._qpath.moveTo(*first)
+                for point in rest:
                     self._qpath.lineTo(*point)
                 self._qpath.closeSubpath()
         return self._qpath
@@ -266,7 +621,7 @@ class Path:
             cur_subpath.pop()
         if len(cur_subpath) >= 3:
             subpaths.append(cur_subpath)
-        return cls(*subpaths) if subpaths else None
+        return cls(*subpaths).normalized() if subpaths else None
 
     @classmethod
     def from_rect(cls, *args):
@@ -280,8 +635,67 @@ class Path:
             )
 
     def to_json(self):
-        return self._subpaths
+        return [list(self.points(k)) for k in range(self.subpath_count)]
 
     @classmethod
     def from_json(cls, data):
-        return cls(*data)
+        """Reuses an identical path from `path_cache` if there is one"""
+        return path_cache.intern(cls(*data))
+
+
+class PathCache:
+    """LRU cache of paths keyed by their vertex data
+
+    Paths are immutable, so a path rebuilt from saved data (on undo, redo
+    or reopening a map) can be swapped for an identical one that was built
+    before, along with whatever that one already derived: its bounding
+    box, `qpath`, edge table and so on.
+    """
+    def __init__(self, max_vertices=PATH_CACHE_MAX_VERTICES):
+        self.max_vertices = max_vertices
+        self._paths = OrderedDict()
+        self._vertices = 0
+        # Paths can also be loaded by background saves
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._paths)
+
+    @staticmethod
+    def _key(path):
+        digest = hashlib.blake2b(path._coords.typecode.encode(), digest_size=16)
+        digest.update(path._coords)
+        digest.update(path._offsets)
+        return digest.digest()
+
+    def intern(self, path):
+        """Returns the cached path with the same vertices, or caches and returns this one"""
+        if path is None:
+            return None
+        key = self._key(path)
+        with self._lock:
+            cached = self._paths.get(key)
+            if (
+                cached is not None
+                and cached._coords.typecode == path._coords.typecode
+                and cached._coords == path._coords
+                and cached._offsets == path._offsets
+            ):
+                self._paths.move_to_end(key)
+                return cached
+            if cached is not None:
+                self._vertices -= len(cached._coords) // 2
+            self._paths[key] = path
+            self._vertices += len(path._coords) // 2
+            while self._vertices > self.max_vertices and len(self._paths) > 1:
+                _, evicted = self._paths.popitem(last=False)
+                self._vertices -= len(evicted._coords) // 2
+        return path
+
+    def clear(self):
+        with self._lock:
+            self._paths.clear()
+            self._vertices = 0
+
+
+path_cache = PathCache()
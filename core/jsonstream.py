@@ -0,0 +1,330 @@
+"""Incremental reading and writing of JSON map files
+
+`dump` writes a `MapSnapshot` one room or door at a time instead of
+building the whole `to_json()` tree first. `load` reads the file in
+chunks, only ever decoding one room or door at a time. It keeps each
+floor as its JSON text in a `LazyFloor` until the floor is first
+accessed, finding where the text ends by its brackets alone, and then
+builds the floor's objects as the text is parsed.
+Unaccessed floors are written back out as the exact text they were
+loaded from, as long as it is laid out the way it is being written.
+"""
+
+import functools
+import io
+import itertools
+import json
+import operator
+import re
+
+from core.model import Door, Floor, LazyFloor, Map, Room
+
+
+# How much of the file is read at a time while parsing
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR = re.compile(r'[^ \t\n\r,:\]}]*')
+_BRACKET = re.compile(r'[\[\]{}]')
+_ANY_SPACE = re.compile(r'[ \t\n\r]')
+# For counting brackets in UTF-8 text: opening ones become 2, closing ones 0, the rest goes
+_BRACKET_STEPS = bytes.maketrans(b'[{]}', b'\x02\x02\x00\x00')
+_NOT_BRACKETS = bytes(set(range(256)) - set(b'[{]}'))
+_decoder = json.JSONDecoder()
+
+
+class _Scanner:
+    """Walks through JSON text read incrementally from a file"""
+    def __init__(self, f):
+        self._file = f
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        # Pieces of the text being captured that have already left the buffer
+        self._captured = None
+        self._capture_start = 0
+
+    def _fill(self, size=None):
+        """Reads more of the file, dropping what has been consumed. Returns False at the end."""
+        chunk = self._file.read(size or CHUNK_SIZE)
+        if not chunk:
+            self._eof = True
+            return False
+        if self._captured is not None:
+            self._captured.append(self._buffer[self._capture_start:self._pos])
+            self._capture_start = 0
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _more(self, pos):
+        """Reads more of the file, returning where `pos` in the buffer has moved to
+
+        Reads at least as much as is left unconsumed, so that scanning a large
+        value again from the start each time adds up to linear time.
+        """
+        start = self._pos
+        if not self._fill(max(CHUNK_SIZE, 2 * (len(self._buffer) - start))):
+            raise json.JSONDecodeError("Unexpected end of file", self._buffer, pos)
+        return pos - start
+
+    def _end_of_value(self, consume=False):
+        """Finds where the next value ends in the buffer, reading as much of the file as it takes
+
+        Containers are scanned for brackets outside of strings without decoding
+        anything. With consume=True, what has been scanned is consumed along
+        the way, so that the buffer never has to hold all of a large value.
+        """
+        pos = self._pos
+        while True:
+            buffer = self._buffer
+            char = buffer[pos]
+            if char in '[{':
+                break
+            if char == '"':
+                match = _STRING.match(buffer, pos)
+                if match:
+                    return match.end()
+            else:
+                # A number at the very end of the buffer might have been cut short
+                end = _SCALAR.match(buffer, pos).end()
+                if end < len(buffer) or self._eof:
+                    return end
+            pos = self._more(pos)
+
+        depth = 1
+        pos += 1
+        while True:
+            buffer = self._buffer
+            quote = buffer.find('"', pos)
+            end = len(buffer) if quote == -1 else quote
+            steps = buffer[pos:end].encode().translate(_BRACKET_STEPS, _NOT_BRACKETS)
+            closing = steps.count(0)
+            if closing < depth:
+                depth += len(steps) - 2 * closing
+            else:
+                # How far the depth has changed after each bracket
+                changes = list(map(operator.sub, itertools.accumulate(steps), itertools.count(1)))
+                if min(changes) <= -depth:
+                    last = changes.index(-depth)
+                    return next(itertools.islice(
+                        _BRACKET.finditer(buffer, pos, end), last, None
+                    )).end()
+                depth += changes[-1]
+            pos = end
+            if quote != -1:
+                match = _STRING.match(buffer, quote)
+                if match:
+                    pos = match.end()
+                    continue
+            if consume:
+                self._pos = pos
+            pos = self._more(pos)
+
+    def peek(self):
+        """Skips whitespace and returns the next character, or '' at the end of the file"""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self._buffer, self._pos)
+        self._pos += 1
+
+    def value(self):
+        """Decodes the next complete value"""
+        if not self.peek():
+            raise json.JSONDecodeError("Expecting value", self._buffer, self._pos)
+        # Only decoded once it is known to be all there
+        self._end_of_value()
+        value, self._pos = _decoder.raw_decode(self._buffer, self._pos)
+        return value
+
+    def skip(self):
+        """Moves past the next value without decoding it"""
+        if not self.peek():
+            raise json.JSONDecodeError("Expecting value", self._buffer, self._pos)
+        self._pos = self._end_of_value(consume=True)
+
+    def object(self):
+        """Yields each key of an object. The caller must consume each value."""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self._pos += 1
+            else:
+                self.expect('}')
+                return
+
+    def array(self):
+        """Yields once per element of an array. The caller must consume each element."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == ',':
+                self._pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def capture(self, consume):
+        """Returns the text of whatever `consume()` reads"""
+        self.peek()
+        self._captured = []
+        self._capture_start = self._pos
+        try:
+            consume()
+            self._captured.append(self._buffer[self._capture_start:self._pos])
+            return ''.join(self._captured)
+        finally:
+            self._captured = None
+
+
+def _read_floor(scanner):
+    name = None
+    rooms = []
+    door_data = []
+    for key in scanner.object():
+        if key == 'rooms':
+            for _ in scanner.array():
+                rooms.append(Room.from_json(scanner.value()))
+        elif key == 'doors':
+            for _ in scanner.array():
+                door_data.append(scanner.value())  # Resolved once every room is known
+        elif key == 'name':
+            name = scanner.value()
+        else:
+            scanner.value()
+    floor = Floor(rooms, name=name)
+    floor._load_doors(Door.from_json(data, floor._rooms_by_id) for data in door_data)
+    return floor
+
+
+def _read_floor_text(text):
+    return _read_floor(_Scanner(io.StringIO(text)))
+
+
+def load(f, lazy=True):
+    """Reads a map from a text file. With lazy=True, floors are built on first access."""
+    scanner = _Scanner(f)
+    floors = []
+    settings = {}
+    for key in scanner.object():
+        if key == 'floors':
+            for _ in scanner.array():
+                if lazy:
+                    text = scanner.capture(scanner.skip)
+                    floors.append(LazyFloor(functools.partial(_read_floor_text, text), text))
+                else:
+                    floors.append(_read_floor(scanner))
+        else:
+            settings[key] = scanner.value()
+    return Map(floors, **settings)
+
+
+class _Writer:
+    def __init__(self, f, compact):
+        self._write = f.write
+        self._compact = compact
+        if compact:
+            self._item_separator, self._key_separator = ',', ':'
+        else:
+            self._item_separator, self._key_separator = ',', ': '
+
+    def newline(self, depth):
+        if not self._compact:
+            self._write('\n' + '  ' * depth)
+
+    def value(self, value, depth):
+        if self._compact:
+            self._write(json.dumps(value, separators=(',', ':')))
+        else:
+            self._write(json.dumps(value, indent=2).replace('\n', '\n' + '  ' * depth))
+
+    def array(self, elements, depth, write_element):
+        """Writes an array, calling write_element(element, depth) for each element"""
+        self._write('[')
+        empty = True
+        for element in elements:
+            if not empty:
+                self._write(self._item_separator)
+            empty = False
+            self.newline(depth + 1)
+            write_element(element, depth + 1)
+        if not empty:
+            self.newline(depth)
+        self._write(']')
+
+    def object(self, fields, depth):
+        """Writes an object from (key, write_value) pairs, calling write_value(depth)"""
+        self._write('{')
+        for i, (key, write_value) in enumerate(fields):
+            if i:
+                self._write(self._item_separator)
+            self.newline(depth + 1)
+            self._write(json.dumps(key) + self._key_separator)
+            write_value(depth + 1)
+        self.newline(depth)
+        self._write('}')
+
+    def _matches_layout(self, text, depth):
+        """Whether JSON text read from a file is laid out the way this would write it at depth"""
+        text = _STRING.sub('""', text)
+        if self._compact:
+            return _ANY_SPACE.search(text) is None
+        # Each element and each closing bracket of a non-empty container is on a line of its own
+        return (
+            text.startswith('{\n' + '  ' * (depth + 1))
+            and text.endswith('\n' + '  ' * depth + '}')
+            and text.count(',') == text.count(',\n')
+            and text.count(':') == text.count(': ')
+            and all(
+                text.count(opening) == text.count(opening + '\n') + text.count(opening + closing)
+                and text.count(closing) == (
+                    text.count(' ' + closing) + text.count('\n' + closing)
+                    + text.count(opening + closing)
+                )
+                for opening, closing in ('[]', '{}')
+            )
+        )
+
+    def floor(self, floor, depth):
+        if isinstance(floor, LazyFloor):
+            if floor.text is not None and self._matches_layout(floor.text, depth):
+                self._write(floor.text)
+                return
+            floor = floor.load().snapshot()
+        self.object([
+            ('name', lambda depth: self.value(floor.name, depth)),
+            ('rooms', lambda depth: self.array(floor.rooms, depth, self.to_json)),
+            ('doors', lambda depth: self.array(floor.doors, depth, self.to_json)),
+        ], depth)
+
+    def to_json(self, obj, depth):
+        self.value(obj.to_json(), depth)
+
+
+def dump(snapshot, f, compact=False):
+    """Writes a `MapSnapshot` to a text file, indented unless compact=True"""
+    writer = _Writer(f, compact)
+    writer.object([
+        ('floors', lambda depth: writer.array(snapshot.floors, depth, writer.floor)),
+        *(
+            (key, lambda depth, value=value: writer.value(value, depth))
+            for key, value in snapshot.settings.items()
+        ),
+    ], 0)
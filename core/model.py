@@ -1,14 +1,167 @@
 """Data specifically relevant to the app
 """
 
+import functools
+import itertools
 import json
+import math
+import os
+import shutil
+import tempfile
 import uuid
-from collections import deque
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from PySide2.QtCore import QPoint, QPointF, Qt
-from PySide2.QtGui import QColor
+from core.bitmap import CellBitmap
+from core.geometry import Path, Point, Orientation, Vector2, path_cache
+from core.spatial import GridIndex
 
-from core.geometry import Path, Point, Orientation, Vector2
+
+DEFAULT_ROOM_COLOR = '#ffffff'
+
+# How far outside of a door's extent `door_at` can search using the spatial index
+DOOR_INDEX_MARGIN = 0.5
+
+# Appended to a map's filename for its journal of changes since the last full save
+JOURNAL_SUFFIX = '.journal'
+
+# Saves run one at a time, in the order they were requested, off of the calling thread
+_save_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='map-save')
+
+
+def _replace_file(file, write, mode='w'):
+    """Writes to a temporary file next to the target, then renames it over the target
+
+    A crash part way through leaves either the old file or the new one,
+    never a mix of the two.
+    """
+    file = os.path.abspath(file)
+    fd, temp = tempfile.mkstemp(
+        prefix=f".{os.path.basename(file)}.",
+        suffix='.tmp',
+        dir=os.path.dirname(file)
+    )
+    try:
+        with open(fd, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(file):
+            shutil.copymode(file, temp)
+        os.replace(temp, file)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def _append_lines(file, lines):
+    with open(file, 'a') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class ItemSnapshot(namedtuple('_ItemSnapshot', ['position', 'label', 'label_pos_hint', 'icon'])):
+    """Immutable copy of an `Item`"""
+    def restore(self):
+        return Item(self.position, self.label, self.label_pos_hint, self.icon)
+
+    def to_json(self):
+        return Item.to_json(self)
+
+
+class DoorSnapshot(namedtuple(
+    '_DoorSnapshot',
+    ['position', 'normal', 'extent', 'room_ids', 'type', 'notes']
+)):
+    """Immutable copy of a `Door`, referring to its rooms by id"""
+    def restore(self, rooms_by_id):
+        return Door(
+            self.position,
+            self.normal,
+            tuple(rooms_by_id.get(id) for id in self.room_ids),
+            self.extent * 2,
+            self.type,
+            self.notes,
+        )
+
+    def to_json(self):
+        return {
+            'position': self.position,
+            'normal': self.normal,
+            'size': self.extent * 2,
+            'rooms': list(self.room_ids),
+            'type': self.type,
+            'notes': self.notes,
+        }
+
+
+class RoomSnapshot(namedtuple('_RoomSnapshot', ['id', 'shape', 'name', 'color', 'items'])):
+    """Immutable copy of a `Room`. The shape `Path` is shared, not copied."""
+    def restore(self):
+        room = Room(self.shape, self.name, self.color, [item.restore() for item in self.items])
+        room._id = self.id
+        room._snapshot = self
+        return room
+
+    def to_json(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'shape': self.shape.to_json(),
+            'color': self.color,
+            'items': [item.to_json() for item in self.items],
+        }
+
+
+class FloorSnapshot(namedtuple('_FloorSnapshot', ['name', 'rooms', 'doors'])):
+    """Immutable copy of a `Floor`. Unchanged rooms share their snapshots between versions."""
+    def restore(self):
+        floor = Floor([room.restore() for room in self.rooms], name=self.name)
+        floor._load_doors(door.restore(floor._rooms_by_id) for door in self.doors)
+        floor._snapshot = self
+        return floor
+
+    def to_json(self):
+        return {
+            'name': self.name,
+            'rooms': [room.to_json() for room in self.rooms],
+            'doors': [door.to_json() for door in self.doors],
+        }
+
+
+class MapSnapshot(namedtuple('_MapSnapshot', ['floors', 'settings'])):
+    """Immutable copy of a `Map`. Unchanged floors share their snapshots between versions."""
+    def restore(self):
+        return Map([floor.restore() for floor in self.floors], **self.settings)
+
+    def to_json(self):
+        return {
+            'floors': [floor.to_json() for floor in self.floors],
+            **self.settings
+        }
+
+    def save(self, file, format='json', compact=False):
+        """Atomically replaces the file with this snapshot and discards the file's journal
+
+        JSON is indented unless compact=True.
+        """
+        if format == 'binary':
+            from core import binary
+            _replace_file(file, lambda f: binary.dump(self, f), mode='wb')
+        else:
+            from core import jsonstream
+            _replace_file(file, lambda f: jsonstream.dump(self, f, compact))
+        if os.path.exists(file + JOURNAL_SUFFIX):
+            os.remove(file + JOURNAL_SUFFIX)
+
+
+class LazyShape:
+    """Stand-in for a room's `Path` that is only decoded the first time it is needed"""
+    def __init__(self, load, bounding_box):
+        self.load = load
+        self.bounding_box = bounding_box
 
 
 class Item:
@@ -29,6 +182,9 @@ class Item:
             'label_pos_hint': self.label_pos_hint
         }
 
+    def snapshot(self):
+        return ItemSnapshot(self.position, self.label, self.label_pos_hint, self.icon)
+
     @classmethod
     def from_json(cls, data):
         return cls(
@@ -48,6 +204,7 @@ class Door:
         self.notes = notes
         self.extent = size / 2
         self._deleteme = False
+        self._snapshot = None
 
     @property
     def colors(self):
@@ -57,6 +214,7 @@ class Door:
         self._deleteme = True
 
     def flip(self):
+        self._snapshot = None
         self.normal = -self.normal
         a, b = self._rooms
         self._rooms = b, a
@@ -68,6 +226,26 @@ class Door:
             and abs(self.normal.rotated90cw.dot(offset)) < self.extent
         )
 
+    @property
+    def bounding_box(self):
+        """Conservative bounds of everything `hit_test` can hit with the index margin"""
+        radius = math.hypot(self.extent, DOOR_INDEX_MARGIN)
+        x, y = self.position
+        return x - radius, y - radius, x + radius, y + radius
+
+    def snapshot(self):
+        """Immutable copy of the door, cached until it is next changed"""
+        if self._snapshot is None:
+            self._snapshot = DoorSnapshot(
+                self.position,
+                self.normal,
+                self.extent,
+                tuple(r.id for r in self._rooms),
+                self.type,
+                self.notes,
+            )
+        return self._snapshot
+
     def to_json(self):
         return {
             'position': self.position,
@@ -79,11 +257,8 @@ class Door:
         }
 
     @classmethod
-    def from_json(cls, data, rooms_on_floor):
-        def get_room_by_id(id):
-            for room in rooms_on_floor:
-                if room.id == id:
-                    return room
+    def from_json(cls, data, rooms_by_id):
+        """`rooms_by_id` maps the ids of the rooms on the door's floor to the rooms"""
         normal = (
             Vector2(*data['normal'])
             if 'normal' in data else
@@ -92,7 +267,7 @@ class Door:
         return cls(
             Point(*data['position']),
             normal,
-            tuple(get_room_by_id(id) for id in data['rooms']),
+            tuple(rooms_by_id.get(id) for id in data['rooms']),
             data.get('size', 1),
             data.get('type'),
             data.get('notes'),
@@ -104,39 +279,54 @@ class Door:
             return False
         offset = self.normal * 0.2
         return (
-            (self.position - offset) in self._rooms[0].shape
-            and (self.position + offset) in self._rooms[1].shape
+            self._rooms[0].contains(self.position - offset)
+            and self._rooms[1].contains(self.position + offset)
         )
 
-    def make_consistent(self):
+    def make_consistent(self, derivative_at=None):
+        """Moves the door onto whichever rooms its rooms were split into
+
+        derivative_at(room, point) finds the derivative of the room that
+        contains the point. By default, the derivatives are searched in order.
+        """
+        if derivative_at is None:
+            derivative_at = _derivative_at
         offset = self.normal * 0.2
         room_a, room_b = self._rooms
         back = (self.position - offset)
         front = (self.position + offset)
-        if room_a.shape is None or back not in room_a.shape:
-            for room in room_a.derivatives:
-                if back in room.shape:
-                    room_a = room
-                    break
-            else:
+        if room_a.bounding_box is None or not room_a.contains(back):
+            room_a = derivative_at(room_a, back)
+            if room_a is None:
                 self._deleteme = True
                 return
-        if room_b.shape is None or front not in room_b.shape:
-            for room in room_b.derivatives:
-                if front in room.shape:
-                    room_b = room
-                    break
-            else:
+        if room_b.bounding_box is None or not room_b.contains(front):
+            room_b = derivative_at(room_b, front)
+            if room_b is None:
                 self._deleteme = True
                 return
         self._rooms = room_a, room_b
 
 
+def _derivative_at(room, point):
+    for derivative in room.derivatives:
+        if derivative.contains(point):
+            return derivative
+
+
 class Room:
     def __init__(self, shape, name=None, color=None, items=()):
         self._id = str(uuid.uuid4())
+        self._lazy_shape = None
+        self._cells = None
         if isinstance(shape, Path):
-            self._shape = shape
+            self._shape = path_cache.intern(shape)
+        elif isinstance(shape, LazyShape):
+            self._shape = None
+            self._lazy_shape = shape
+        elif isinstance(shape, CellBitmap):
+            self._shape = None
+            self._cells = shape
         elif isinstance(shape, list):
             if isinstance(shape[0], tuple):
                 self._shape = Path(shape)
@@ -144,14 +334,15 @@ class Room:
                 self._shape = Path(*shape)
         else:
             raise TypeError(shape)
+        self._snapshot = None
         self.name = name
-        self.color = color or QColor('white')
+        self.color = color or DEFAULT_ROOM_COLOR  # as a '#rrggbb' string
         self._items = list(items)
 
         # For internal use (e.g. undo/redo, room links)
         self._room_split = None
 
-        self._door_links = []
+        self._door_links = {}  # doors touching this room, as an ordered set
         self._derivatives = []
 
     def __repr__(self):
@@ -164,14 +355,16 @@ class Room:
             return repr(self).strip('<>')
 
     def get_path(self):
-        return self._shape.qpath
+        return self.shape.qpath
 
     def add_item(self, item):
+        self._snapshot = None
         to_delete = self.item_at(item.position)
         self._items = [item for item in self._items if item is not to_delete]
         self._items.append(item)
 
     def remove_item(self, item):
+        self._snapshot = None
         self._items.remove(item)
 
     def item_at(self, point, within=0.45):
@@ -181,39 +374,104 @@ class Room:
 
     def split_if_needed(self):
         """WARNING: this mutates the room in place as well as creating new rooms!"""
-        if not self._shape:
+        if self.bounding_box is None:
             self._derivatives = []
             return None
         if self._room_split is None:
-            self._room_split = self._shape.shapes()
+            if self._shape is None and self._cells is not None:
+                self._room_split = self._cells.components()
+            else:
+                self._room_split = self.shape.shapes()
         if len(self._room_split) > 1:
-            # TODO: make this transactional (to be exception-safe)
-            all_items = self._items
-            self._shape, *rest = self._room_split
-            self._items = [item for item in all_items if item.position in self._shape]
-            self._room_split = None
-            self._derivatives = [
+            # Everything is computed before anything is assigned, to be exception-safe
+            positions = [item.position for item in self._items]
+            first, *rest = self._room_split
+            items = [
+                item for item, inside in zip(self._items, first.contains_many(positions))
+                if inside
+            ]
+            derivatives = [
                 self.__class__(
                     shape,
                     name=f"{self.name} ({i})",
                     color=self.color,
-                    items=(item for item in all_items if item.position in shape)
+                    items=[
+                        item for item, inside in zip(self._items, shape.contains_many(positions))
+                        if inside
+                    ]
                 )
                 for i, shape in enumerate(rest)
             ]
+            if isinstance(first, CellBitmap):
+                self.cells = first
+            else:
+                self.shape = first
+            self._items = items
+            self._derivatives = derivatives
             return self._derivatives
 
     # -- properties --
 
     @property
     def shape(self):
+        if self._shape is None:
+            if self._lazy_shape is not None:
+                self._shape = self._lazy_shape.load()
+                self._lazy_shape = None
+            elif self._cells is not None:
+                self._shape = path_cache.intern(self._cells.to_path())
         return self._shape
 
     @shape.setter
     def shape(self, value):
-        self._shape = value
+        # Cached so that undo, redo and reloading can find the same path again
+        self._shape = path_cache.intern(value)
+        self._lazy_shape = None
+        self._cells = None
+        self._snapshot = None
+        self._room_split = None
+
+    @property
+    def cells(self):
+        """The shape as a `CellBitmap`, or None if it isn't grid-aligned or there is none"""
+        if self._cells is None:
+            shape = self.shape
+            if shape is not None and shape.is_grid_aligned:
+                self._cells = CellBitmap.from_path(shape)
+        return self._cells
+
+    @cells.setter
+    def cells(self, value):
+        # The outline is only traced once `shape` is next read, e.g. to paint the room
+        self._cells = value or None
+        self._shape = None
+        self._lazy_shape = None
+        self._snapshot = None
         self._room_split = None
 
+    @property
+    def bounding_box(self):
+        """None if the room has no shape (e.g. it has been removed)"""
+        if self._shape is None:
+            if self._lazy_shape is not None:
+                return self._lazy_shape.bounding_box
+            if self._cells is not None:
+                return self._cells.bounding_box
+            return None
+        return self._shape.bounding_box
+
+    def contains(self, point):
+        """`point in self.shape`, without tracing the outline of a room edited as cells"""
+        if self._shape is None and self._cells is not None:
+            return point in self._cells
+        return point in self.shape
+
+    def contains_many(self, points):
+        """Batched `contains`. Returns a list of bools, one for each point."""
+        if self._shape is None and self._cells is not None:
+            return self._cells.contains_many(points)
+        return self.shape.contains_many(points)
+
     @property
     def id(self):
         return self._id
@@ -228,50 +486,237 @@ class Room:
 
     # -- conversions --
 
-    def to_json(self):
+    def snapshot(self):
+        """Immutable copy of the room, cached until it is next changed"""
+        if self._snapshot is None:
+            self._snapshot = RoomSnapshot(
+                self.id,
+                self.shape,
+                self.name,
+                self.color,
+                tuple(item.snapshot() for item in self._items),
+            )
+        return self._snapshot
+
+    def load_state(self, data):
+        """Overwrites the room in place with serialized data from `to_json`"""
+        if 'cells' in data:
+            self.cells = CellBitmap.from_json(data['cells'])
+        else:
+            self.shape = Path.from_json(data['shape'])
+        self.name = data['name']
+        self.color = data.get('color', DEFAULT_ROOM_COLOR)
+        self._items = [Item.from_json(obj) for obj in data.get('items', [])]
+        self._derivatives = []
+
+    def to_json(self, trace=True):
+        """With trace=False, a room edited as cells keeps them instead of its traced outline"""
+        if not trace and self._shape is None and self._cells is not None:
+            area = {'cells': self._cells.to_json()}
+        else:
+            area = {'shape': self.shape.to_json()}
         return {
             'id': self.id,
             'name': self.name,
-            'shape': self.shape.to_json(),
-            'color': self.color.name(),
+            **area,
+            'color': self.color,
             'items': [item.to_json() for item in self._items]
         }
 
     @classmethod
     def from_json(cls, data):
         room = cls(
-            Path.from_json(data['shape']),
+            CellBitmap.from_json(data['cells']) if 'cells' in data
+            else Path.from_json(data['shape']),
             data['name'],
-            QColor(data.get('color', 'white')),
+            data.get('color', DEFAULT_ROOM_COLOR),
             [Item.from_json(obj) for obj in data.get('items', [])]
         )
         room._id = data['id']
         return room
 
 
+class _FloorJournal:
+    """Remembers the state of everything a batch edit touches, so it can be rolled back"""
+    def __init__(self, floor):
+        self.floor = floor
+        self.rooms = dict(floor._rooms)
+        self.rooms_by_id = dict(floor._rooms_by_id)
+        self.doors = dict(floor._doors)
+        self.dirty_rooms = dict(floor._dirty_rooms)
+        self.dirty_doors = dict(floor._dirty_doors)
+        self.room_states = {}
+        self.door_states = {}
+
+    def save_room(self, room):
+        if room not in self.room_states:
+            if room._lazy_shape is not None:
+                room.shape  # Decode a lazily loaded shape so it gets saved too
+            self.room_states[room] = (
+                room._shape,
+                room._cells,
+                room._room_split,
+                list(room._items),
+                list(room._derivatives),
+                dict(room._door_links),
+            )
+
+    def save_door(self, door):
+        if door not in self.door_states:
+            self.door_states[door] = door._rooms, door._deleteme
+
+    def rollback(self):
+        for room, state in self.room_states.items():
+            (
+                room._shape,
+                room._cells,
+                room._room_split,
+                room._items,
+                room._derivatives,
+                room._door_links,
+            ) = state
+        for door, (rooms, deleteme) in self.door_states.items():
+            door._rooms = rooms
+            door._deleteme = deleteme
+        floor = self.floor
+        floor._rooms = self.rooms
+        floor._rooms_by_id = self.rooms_by_id
+        floor._doors = self.doors
+        floor._dirty_rooms = self.dirty_rooms
+        floor._dirty_doors = self.dirty_doors
+        floor._moved_rooms = {}
+        floor._snapshot = None
+        floor._room_snapshots.clear()
+        floor._door_snapshots.clear()
+        for obj in itertools.chain(self.room_states, self.door_states):
+            obj._snapshot = None
+        floor._room_index.clear()
+        for room in floor._rooms:
+            floor._room_index.insert(room, room.bounding_box)
+        floor._door_index.clear()
+        for door in floor._doors:
+            floor._door_index.insert(door, door.bounding_box)
+
+
+class _SnapshotCache:
+    """Snapshots of a floor's rooms or doors in floor order, only redone for what changed
+
+    `objects` is the floor's ordered set of rooms or doors, mapping each to
+    its sequence number.
+    """
+    def __init__(self):
+        self._snapshots = None
+        self._changed = {}
+        self._last = -1  # sequence number of the last object with a snapshot, or above it
+
+    def changed(self, obj):
+        if self._snapshots is not None:
+            self._changed[obj] = None
+            if len(self._changed) > len(self._snapshots):
+                self.clear()  # Starting over is cheaper by now
+
+    def clear(self):
+        self._snapshots = None
+        self._changed = {}
+
+    def snapshots(self, objects, keep):
+        """Tuple of the snapshots of the objects for which keep(obj) is true"""
+        if self._snapshots is not None:
+            added = []
+            for obj in self._changed:
+                if obj in objects and keep(obj):
+                    if obj in self._snapshots:
+                        self._snapshots[obj] = obj.snapshot()
+                    else:
+                        added.append(obj)
+                else:
+                    self._snapshots.pop(obj, None)
+            added.sort(key=objects.get)
+            if added and objects[added[0]] < self._last:
+                self._snapshots = None  # Can't just be appended without breaking floor order
+            else:
+                for obj in added:
+                    self._snapshots[obj] = obj.snapshot()
+                    self._last = objects[obj]
+        if self._snapshots is None:
+            self._snapshots = {obj: obj.snapshot() for obj in objects if keep(obj)}
+            self._last = objects[next(reversed(self._snapshots))] if self._snapshots else -1
+        self._changed = {}
+        return tuple(self._snapshots.values())
+
+
 class Floor:
-    def __init__(self, rooms=(), doors=(), name=None):
+    def __init__(self, rooms=(), doors=(), name=None, *, use_cell_bitmaps=False):
         self.name = name
-        self._rooms = list(rooms)
-        self._doors = list(doors)
+        # Edit grid-aligned rooms as cell bitmaps instead of with polygon booleans
+        self.use_cell_bitmaps = use_cell_bitmaps
+        # Rooms and doors are ordered sets, mapping to sequence numbers to keep floor order
+        self._sequence = itertools.count()
+        self._rooms = {room: next(self._sequence) for room in rooms}
+        self._rooms_by_id = {room.id: room for room in self._rooms}
+        self._doors = {}
+        # What was touched by edits since the last consistency cleanup
+        self._dirty_rooms = {}
+        self._dirty_doors = {}
+        # Rooms whose bounds may have changed since the spatial index was last updated
+        self._moved_rooms = {}
+        self._journal = None
+        # Serialized state of each room or door from before it was first changed (for undo)
+        self._change_log = None
+        # Bounds of each room or door from before it was first changed (for repainting)
+        self._damage = None
+        self._snapshot = None
+        self._room_snapshots = _SnapshotCache()
+        self._door_snapshots = _SnapshotCache()
+        self._room_index = GridIndex()
+        self._door_index = GridIndex()
+        for room in self._rooms:
+            self._room_index.insert(room, room.bounding_box)
+        self._load_doors(doors)
+
+    def _load_doors(self, doors):
+        for door in doors:
+            self._doors[door] = next(self._sequence)
+            self._door_snapshots.changed(door)
+            self._link_door(door)
+            self._door_index.insert(door, door.bounding_box)
 
     def rooms(self):
         yield from self._rooms
 
+    def room_by_id(self, id):
+        """The room on this floor with the given id, or None"""
+        return self._rooms_by_id.get(id)
+
     def doors(self):
         yield from self._doors
 
     def room_at(self, point):
-        if isinstance(point, (QPoint, QPointF)):
-            point = Point(point.x(), point.y())
-        for room in self._rooms:
-            if point in room.shape:
+        for room in self._room_index.query_point(point):
+            if room.contains(point):
                 return room
 
+    def rooms_at(self, points):
+        """Batched `room_at`. Returns a list with a room (or None) for each point."""
+        points = [Point(*p) for p in points]
+        by_room = {}
+        for i, point in enumerate(points):
+            for room in self._room_index.query_point(point):
+                by_room.setdefault(room, []).append(i)
+        result = [None] * len(points)
+        for room, indices in by_room.items():
+            inside = room.contains_many([points[i] for i in indices])
+            for i, is_inside in zip(indices, inside):
+                if is_inside and result[i] is None:
+                    result[i] = room
+        return result
+
     def door_at(self, point, within=0.15):
-        if isinstance(point, (QPoint, QPointF)):
-            point = Point(point.x(), point.y())
-        for door in self._doors:
+        if within > DOOR_INDEX_MARGIN:
+            candidates = self._doors
+        else:
+            candidates = self._door_index.query_point(point)
+        for door in candidates:
             if door.hit_test(point, within):
                 return door
 
@@ -280,50 +725,192 @@ class Floor:
         if room:
             return room.item_at(point, within)
 
-    def new_room(self, shape, color=Qt.white, *, replace=True):
-        for room in self._rooms:
-            if room.shape.intersects(shape):
+    def rooms_in_rect(self, minx, miny, maxx, maxy):
+        """Yields rooms whose bounding boxes overlap the given rectangle, in floor order"""
+        yield from sorted(
+            self._room_index.query_rect(minx, miny, maxx, maxy),
+            key=self._rooms.get
+        )
+
+    def doors_in_rect(self, minx, miny, maxx, maxy):
+        """Yields doors whose bounding boxes overlap the given rectangle"""
+        yield from self._door_index.query_rect(minx, miny, maxx, maxy)
+
+    def _rooms_near(self, shape):
+        """Rooms whose bounding boxes overlap the shape's, in floor order"""
+        return list(self.rooms_in_rect(*shape.bounding_box))
+
+    def _before_change(self, obj, is_new=False):
+        self._snapshot = None
+        obj._snapshot = None
+        if isinstance(obj, Room):
+            self._room_snapshots.changed(obj)
+        else:
+            self._door_snapshots.changed(obj)
+        if self._change_log is not None and obj not in self._change_log:
+            if is_new:
+                self._change_log[obj] = None
+            else:
+                self._change_log[obj] = (
+                    obj.to_json(trace=False) if isinstance(obj, Room) else obj.to_json()
+                )
+        self._mark_damage(obj, is_new)
+
+    def _mark_damage(self, obj, is_new=False):
+        if self._damage is not None and obj not in self._damage:
+            self._damage[obj] = None if is_new else obj.bounding_box
+
+    def _add_room(self, room):
+        self._before_change(room, is_new=True)
+        self._rooms[room] = next(self._sequence)
+        self._rooms_by_id[room.id] = room
+        self._dirty_rooms[room] = None
+        self._moved_rooms[room] = None
+
+    def _touch(self, room):
+        self._before_change(room)
+        if self._journal:
+            self._journal.save_room(room)
+        self._dirty_rooms[room] = None
+        self._moved_rooms[room] = None
+
+    def _touch_door(self, door):
+        self._before_change(door)
+        if self._journal:
+            self._journal.save_door(door)
+
+    def _link_door(self, door):
+        for room in door._rooms:
+            if room is not None:
+                if self._journal:
+                    self._journal.save_room(room)
+                room._door_links[door] = None
+
+    def _unlink_door(self, door):
+        for room in door._rooms:
+            if room is not None:
+                if self._journal:
+                    self._journal.save_room(room)
+                room._door_links.pop(door, None)
+
+    @contextmanager
+    def batch(self):
+        """Groups several edits, deferring room splitting and door reconciliation to the end
+
+        If anything inside the block raises, all of its edits are rolled
+        back. Nested batches are part of the outermost one.
+        """
+        if self._journal:
+            yield self
+            return
+        journal = self._journal = _FloorJournal(self)
+        try:
+            yield self
+            self._consistency_cleanup()
+        except BaseException:
+            journal.rollback()
+            raise
+        finally:
+            self._journal = None
+
+    def _edited(self):
+        """Called after each edit. Cleans up right away unless in a batch."""
+        for room in self._moved_rooms:
+            if room.bounding_box is None:
+                self._room_index.remove(room)
+            else:
+                self._room_index.update(room, room.bounding_box)
+        self._moved_rooms = {}
+        if not self._journal:
+            self._consistency_cleanup()
+
+    def _cells_for(self, shape):
+        """The shape as a `CellBitmap` if it should be edited as one, otherwise None"""
+        if self.use_cell_bitmaps and shape.is_grid_aligned:
+            return CellBitmap.from_path(shape)
+
+    @staticmethod
+    def _overlaps(room, shape, cells):
+        if cells is not None and room.cells is not None:
+            return room.cells.intersects(cells)
+        return room.shape.intersects(shape)
+
+    def _cut(self, room, shape, cells=None):
+        self._touch(room)
+        if cells is not None and room.cells is not None:
+            room.cells -= cells
+        else:
+            room.shape -= shape
+
+    def new_room(self, shape, color=DEFAULT_ROOM_COLOR, *, replace=True):
+        cells = self._cells_for(shape)
+        for room in self._rooms_near(shape):
+            if self._overlaps(room, shape, cells):
                 if replace:
-                    room.shape -= shape
+                    self._cut(room, shape, cells)
+                elif cells is not None and room.cells is not None:
+                    cells -= room.cells
+                    if not cells:
+                        break
                 else:
+                    if cells is not None:
+                        shape, cells = cells.to_path(), None  # The room is off the grid
                     shape -= room.shape
+                    if not shape:
+                        break
+        if not replace and cells is not None:
+            shape = cells  # What is left of the shape was only kept up to date as cells
         if shape:
-            self._rooms.append(Room(shape, color=color))
-            self._consistency_cleanup()
+            self._add_room(Room(shape, color=color))
+            self._edited()
 
     def erase_rooms(self, shape):
-        for room in self._rooms:
-            if room.shape.intersects(shape):
-                room.shape -= shape
+        cells = self._cells_for(shape)
+        for room in self._rooms_near(shape):
+            if self._overlaps(room, shape, cells):
+                self._cut(room, shape, cells)
 
-        self._consistency_cleanup()
+        self._edited()
 
     def expand_room(self, target, shape):
-        for room in self._rooms:
-            if room is target:
-                room.shape |= shape
-            elif room.shape.intersects(shape):
-                room.shape -= shape
-        self._consistency_cleanup()
+        cells = self._cells_for(shape)
+        for room in self._rooms_near(shape):
+            if room is not target and self._overlaps(room, shape, cells):
+                self._cut(room, shape, cells)
+        self._touch(target)
+        if cells is not None and target.cells is not None:
+            target.cells |= cells
+        else:
+            target.shape |= shape
+        self._edited()
 
     def combine_rooms(self, shape):
+        cells = self._cells_for(shape)
         to_combine = [
-            room for room in self._rooms
-            if room.shape.intersects(shape)
+            room for room in self._rooms_near(shape)
+            if self._overlaps(room, shape, cells)
         ]
         if to_combine:
             for room in to_combine:
-                shape |= room.shape
-            to_combine[0].shape = shape
+                self._touch(room)
+            if cells is not None and all(room.cells is not None for room in to_combine):
+                for room in to_combine:
+                    cells |= room.cells
+                to_combine[0].cells = cells
+            else:
+                to_combine[0].shape = Path.union_all(
+                    [shape] + [room.shape for room in to_combine]
+                )
             for room in to_combine[1:]:
                 room.shape = None
-            self._consistency_cleanup()
         else:
-            self._rooms.append(Room(shape))
+            self._add_room(Room(shape))
+        self._edited()
 
     def remove_room(self, room):
+        self._touch(room)
         room.shape = None
-        self._consistency_cleanup()
+        self._edited()
 
     def add_door(self, position, normal, size, rooms, type=None):
         room_a, room_b = rooms
@@ -333,24 +920,196 @@ class Floor:
         if door.is_consistent:
             to_overwrite = self.door_at(position)
             if to_overwrite:  # TODO: what if the new door overlaps with multiple existing doors?
+                self._touch_door(to_overwrite)
                 to_overwrite.remove()
-            self._doors.append(door)
-            self._consistency_cleanup()
+                self._dirty_doors[to_overwrite] = None
+            self._before_change(door, is_new=True)
+            self._doors[door] = next(self._sequence)
+            self._link_door(door)
+            self._door_index.insert(door, door.bounding_box)
+            self._dirty_doors[door] = None
+            self._edited()
         else:
             raise ValueError("Inconsistency between rooms and door position")
 
     def remove_door(self, door):
-        self._doors.remove(door)
+        self._touch_door(door)
+        del self._doors[door]
+        self._unlink_door(door)
+        self._door_index.remove(door)
 
     def _consistency_cleanup(self):
-        self._rooms = [room for room in self._rooms if room.shape is not None]
-        new_rooms = []
-        for room in self._rooms:
-            new_rooms.extend(room.split_if_needed() or [])
-        self._rooms.extend(new_rooms)
-        for door in self._doors:
-            door.make_consistent()
-        self._doors = [door for door in self._doors if door.is_consistent]
+        """Splits, reindexes and reconciles doors, but only for what was edited"""
+        dirty_rooms = list(self._dirty_rooms)
+        doors = self._dirty_doors
+        self._dirty_rooms = {}
+        self._dirty_doors = {}
+        split_from = {}  # derivative -> the room it was split off of
+        for room in dirty_rooms:
+            doors.update(room._door_links)
+            if self._journal:
+                self._journal.save_room(room)
+            new_rooms = room.split_if_needed() or []
+            if room.bounding_box is None:
+                self._forget_room(room)
+                continue
+            self._room_index.update(room, room.bounding_box)
+            for new_room in new_rooms:
+                self._before_change(new_room, is_new=True)
+                self._rooms[new_room] = next(self._sequence)
+                self._rooms_by_id[new_room.id] = new_room
+                self._room_index.insert(new_room, new_room.bounding_box)
+                split_from[new_room] = room
+
+        def derivative_at(room, point):
+            for candidate in self._room_index.query_point(point):
+                if split_from.get(candidate) is room and candidate.contains(point):
+                    return candidate
+
+        for door in doors:
+            if door not in self._doors:
+                continue  # removed directly since being marked
+            self._touch_door(door)
+            self._unlink_door(door)
+            door.make_consistent(derivative_at)
+            if door.is_consistent:
+                self._link_door(door)
+                self._door_index.update(door, door.bounding_box)
+            else:
+                del self._doors[door]
+                self._door_index.remove(door)
+
+    def _forget_room(self, room):
+        self._room_snapshots.changed(room)
+        self._rooms.pop(room, None)
+        if self._rooms_by_id.get(room.id) is room:
+            del self._rooms_by_id[room.id]
+        self._room_index.remove(room)
+
+    def snapshot(self):
+        """Immutable copy of the floor
+
+        Snapshots are cached and only rebuilt for what changed since the
+        last one, so unchanged rooms (and their paths) are shared, and cost
+        nothing beyond being copied into the new tuple. Changes made
+        directly to rooms, items or doors rather than through the floor
+        must be announced with `touch` first.
+        """
+        if self._snapshot is None or self._snapshot.name != self.name:
+            self._snapshot = FloorSnapshot(
+                self.name,
+                self._room_snapshots.snapshots(
+                    self._rooms, lambda room: room.bounding_box is not None
+                ),
+                self._door_snapshots.snapshots(self._doors, lambda door: True),
+            )
+        return self._snapshot
+
+    # -- change tracking --
+
+    def take_damage(self):
+        """World-space bounds of everything that may look different since the last call
+
+        Returns a list of (minx, miny, maxx, maxy) tuples. The first call
+        starts the tracking, and returns None to say that everything may
+        have changed.
+        """
+        if self._damage is None:
+            self._damage = {}
+            return None
+        damage = []
+        for obj, before in self._damage.items():
+            if before is not None:
+                damage.append(before)
+            if obj in self._rooms or obj in self._doors:
+                after = obj.bounding_box
+                if after is not None:
+                    damage.append(after)
+        self._damage = {}
+        return damage
+
+    def track_changes(self, enabled=True):
+        """Starts (or stops) recording what is changed, for `take_changes`"""
+        self._change_log = {} if enabled else None
+
+    def touch(self, obj):
+        """Call before changing a room (or its items) or a door directly, so it gets tracked"""
+        self._before_change(obj)
+
+    def take_changes(self):
+        """Returns and forgets everything changed since the last call
+
+        The result is JSON-compatible: `{'rooms': {id: [before, after]},
+        'doors': [befores, afters]}`, where a room state of None means it
+        did not exist. Returns None if nothing changed.
+        """
+        if not self._change_log:
+            return None
+        rooms = {}
+        door_befores = []
+        door_afters = []
+        for obj, before in self._change_log.items():
+            if isinstance(obj, Room):
+                if obj in self._rooms and obj.bounding_box is not None:
+                    after = obj.to_json(trace=False)
+                else:
+                    after = None
+                if before != after:
+                    rooms[obj.id] = [before, after]
+            else:
+                after = obj.to_json() if obj in self._doors else None
+                if before != after:
+                    if before is not None:
+                        door_befores.append(before)
+                    if after is not None:
+                        door_afters.append(after)
+        self._change_log = {}
+        if rooms or door_befores or door_afters:
+            return {'rooms': rooms, 'doors': [door_befores, door_afters]}
+
+    def apply_changes(self, changes, undo=False):
+        """Applies changes from `take_changes` in place, or reverts them with undo=True"""
+        change_log = self._change_log
+        self._change_log = None
+        self._snapshot = None
+        after = 0 if undo else 1
+        door_befores, door_afters = changes['doors']
+        for data in (door_afters if undo else door_befores):
+            position = Point(*data['position'])
+            for door in list(self._door_index.query_point(position)):
+                if door.position == position:
+                    self.remove_door(door)
+
+        for room_id, states in changes['rooms'].items():
+            room = self._rooms_by_id.get(room_id)
+            state = states[after]
+            if state is None:
+                if room is not None:
+                    self._mark_damage(room)
+                    self._forget_room(room)
+                    for door in list(room._door_links):
+                        self.remove_door(door)
+            elif room is None:
+                room = Room.from_json(state)
+                self._mark_damage(room, is_new=True)
+                self._room_snapshots.changed(room)
+                self._rooms[room] = next(self._sequence)
+                self._rooms_by_id[room_id] = room
+                self._room_index.insert(room, room.bounding_box)
+            else:
+                self._mark_damage(room)
+                self._room_snapshots.changed(room)
+                room.load_state(state)
+                self._room_index.update(room, room.bounding_box)
+
+        new_doors = [
+            Door.from_json(data, self._rooms_by_id)
+            for data in (door_befores if undo else door_afters)
+        ]
+        for door in new_doors:
+            self._mark_damage(door, is_new=True)
+        self._load_doors(new_doors)
+        self._change_log = change_log
 
     def to_json(self):
         return {
@@ -361,32 +1120,130 @@ class Floor:
 
     @classmethod
     def from_json(cls, data):
-        rooms = [Room.from_json(r) for r in data['rooms']]
-        return cls(
-            rooms,
-            [Door.from_json(d, rooms) for d in data['doors']],
-            name=data['name']
-        )
+        floor = cls([Room.from_json(r) for r in data['rooms']], name=data['name'])
+        floor._load_doors(Door.from_json(d, floor._rooms_by_id) for d in data['doors'])
+        return floor
+
+class LazyFloor:
+    """Stand-in for a `Floor` that is only built the first time it is accessed
+
+    What it is built from never changes, so it is its own snapshot. `text`
+    is the floor's JSON exactly as it was read, if it was read from JSON
+    text, so that it can be written back out as is.
+    """
+    def __init__(self, load, text=None):
+        self.load = load
+        self.text = text
+
+    def snapshot(self):
+        return self
+
+    def restore(self):
+        return self
+
+    def to_json(self):
+        if self.text is not None:
+            return json.loads(self.text)
+        return self.load().to_json()
+
 
 class Map:
     def __init__(self, floors=None, **settings):
+        # Floors may also be `LazyFloor`s, which are built on first access
         if floors:
             self._floors = list(floors)
         else:
             self._floors = [Floor()]
         self._settings = settings
+        self._track_changes = False
+        self.format = 'json'  # What `save` writes by default: the format last loaded or saved as
+
+    def __len__(self):
+        return len(self._floors)
 
     def __getitem__(self, index):
-        return self._floors[index]
+        floor = self._floors[index]
+        if isinstance(floor, LazyFloor):
+            floor = self._floors[index] = floor.load()
+            floor.track_changes(self._track_changes)
+        return floor
+
+    def floors(self):
+        for i in range(len(self._floors)):
+            yield self[i]
 
-    def save(self, file):
-        with open(file, 'w') as f:  # TODO: Should probably be atomic
-            json.dump(self.to_json(), f, indent=2)
+    def track_changes(self, enabled=True):
+        """`Floor.track_changes` for every floor, including ones that aren't loaded yet"""
+        self._track_changes = enabled
+        for floor in self._floors:
+            if isinstance(floor, Floor):
+                floor.track_changes(enabled)
+
+    def snapshot(self):
+        """Immutable copy of the map that shares everything unchanged with earlier snapshots"""
+        return MapSnapshot(
+            tuple(floor.snapshot() for floor in self._floors),
+            dict(self._settings),
+        )
+
+    def save(self, file, format=None, *, compact=False, wait=True):
+        """Atomically saves as 'json' or 'binary' (see `core.binary`). Defaults to `self.format`.
+
+        An explicitly given format becomes `self.format`, so that later
+        saves keep writing the file in the format it was last saved as.
+        JSON is streamed out (see `core.jsonstream`), indented unless
+        compact=True. The map is snapshotted right away and written out on
+        a worker thread. With wait=False, this returns a
+        `concurrent.futures.Future` for the write instead of blocking until
+        it is done, and the map can keep being edited in the meantime.
+        """
+        from core import binary
+        binary.release(file)  # Lazily loaded floors may still be reading from it
+        if format is not None:
+            self.format = format
+        future = _save_executor.submit(self.snapshot().save, file, self.format, compact)
+        return future.result() if wait else future
+
+    def save_journal(self, file, steps, *, wait=True):
+        """Appends changes to the file's journal instead of rewriting the whole file
+
+        `steps` are (floor index, changes from `Floor.take_changes`, undo)
+        tuples, in the order they were applied since the file (or its
+        journal) was last written. `load` replays the journal, and the next
+        full `save` discards it. Runs in order with `save`, see there for wait.
+        """
+        steps = list(steps)
+
+        def append():
+            _append_lines(file + JOURNAL_SUFFIX, [
+                json.dumps({'floor': floor, 'changes': changes, 'undo': undo}) + '\n'
+                for floor, changes, undo in steps
+            ])
+
+        future = _save_executor.submit(append)
+        return future.result() if wait else future
 
     @classmethod
     def load(cls, file):
-        with open(file, 'r') as f:
-            return cls.from_json(json.load(f))
+        """Opens a JSON or binary map. Floors are only built the first time they are accessed."""
+        from core import binary, jsonstream
+        if binary.is_binary(file):
+            map = binary.load(file)
+        else:
+            with open(file, 'r') as f:
+                map = jsonstream.load(f)
+        if os.path.exists(file + JOURNAL_SUFFIX):
+            map._replay_journal(file + JOURNAL_SUFFIX)
+        return map
+
+    def _replay_journal(self, journal):
+        with open(journal, 'r') as f:
+            for line in f:
+                try:
+                    step = json.loads(line)
+                except ValueError:
+                    break  # The last line may be incomplete if writing it was interrupted
+                self[step['floor']].apply_changes(step['changes'], undo=step['undo'])
 
     def to_json(self):
         return {
@@ -396,6 +1253,10 @@ class Map:
 
     @classmethod
     def from_json(cls, data):
+        """Floors are only built the first time they are accessed"""
         data_copy = dict(data)
-        floors = [Floor.from_json(f) for f in data_copy.pop('floors')]
+        floors = [
+            LazyFloor(functools.partial(Floor.from_json, floor_data))
+            for floor_data in data_copy.pop('floors')
+        ]
         return cls(floors, **data_copy)
@@ -0,0 +1,187 @@
+"""Exact boolean operations on rectilinear (axis-aligned) polygons
+
+Polygons are given as lists of rings, each ring being a list of (x, y)
+points, and are filled using the odd-even rule (same as `Path`).
+
+The plane is cut into horizontal slabs at every distinct y coordinate.
+Within a slab, each polygon covers a set of x intervals, so a boolean
+operation is just a boolean operation on sorted interval lists. The
+outline is then traced back out of the resulting slabs. Coordinates are
+only ever compared, never computed, so results are exact.
+"""
+
+import operator
+
+
+def is_rectilinear(rings):
+    for ring in rings:
+        prev_x, prev_y = ring[-1]
+        for x, y in ring:
+            if x != prev_x and y != prev_y:
+                return False
+            prev_x, prev_y = x, y
+    return True
+
+
+def _vertical_edges(rings):
+    edges = []
+    for ring in rings:
+        prev_x, prev_y = ring[-1]
+        for x, y in ring:
+            if x == prev_x and y != prev_y:
+                edges.append((min(y, prev_y), max(y, prev_y), x))
+            prev_x, prev_y = x, y
+    edges.sort()
+    return edges
+
+
+def slab_coverage(rings, ys):
+    """The x intervals covered by the polygon within each slab between consecutive ys"""
+    edges = _vertical_edges(rings)
+    active = []
+    coverage = []
+    i = 0
+    for y in ys[:-1]:
+        while i < len(edges) and edges[i][0] <= y:
+            active.append(edges[i])
+            i += 1
+        active = [edge for edge in active if edge[1] > y]
+        xs = sorted(x for _, _, x in active)
+        coverage.append([(xs[j], xs[j + 1]) for j in range(0, len(xs) - 1, 2)])
+    return coverage
+
+
+def _combine(a, b, op):
+    """Applies a boolean operator to two sorted lists of x intervals"""
+    events = sorted(
+        [(x, 0) for interval in a for x in interval]
+        + [(x, 1) for interval in b for x in interval]
+    )
+    result = []
+    inside = [False, False]
+    was_inside = False
+    i = 0
+    while i < len(events):
+        x = events[i][0]
+        while i < len(events) and events[i][0] == x:
+            inside[events[i][1]] ^= True
+            i += 1
+        now_inside = op(*inside)
+        if now_inside and not was_inside:
+            start = x
+        elif was_inside and not now_inside:
+            result.append((start, x))
+        was_inside = now_inside
+    return result
+
+
+def _only_first(in_a, in_b):
+    return in_a and not in_b
+
+
+def _boolean_slabs(a, b, op):
+    """Runs the operation slab-by-slab. Returns [(y0, y1, intervals)] with equal runs merged."""
+    ys = sorted({y for ring in a for _, y in ring} | {y for ring in b for _, y in ring})
+    slabs = []
+    for y0, y1, cov_a, cov_b in zip(ys, ys[1:], slab_coverage(a, ys), slab_coverage(b, ys)):
+        intervals = _combine(cov_a, cov_b, op)
+        if slabs and slabs[-1][2] == intervals:
+            slabs[-1] = (slabs[-1][0], y1, intervals)
+        else:
+            slabs.append((y0, y1, intervals))
+    return slabs
+
+
+def _boundary_edges(slabs):
+    """Directed boundary edges of the slabs, with the interior to the right in y-down space"""
+    edges = []
+    above = []
+    for y0, y1, intervals in slabs:
+        for start, end in _combine(intervals, above, _only_first):
+            edges.append(((start, y0), (end, y0)))
+        for start, end in _combine(above, intervals, _only_first):
+            edges.append(((end, y0), (start, y0)))
+        for start, end in intervals:
+            edges.append(((start, y1), (start, y0)))
+            edges.append(((end, y0), (end, y1)))
+        above = intervals
+    if slabs:
+        bottom = slabs[-1][1]
+        for start, end in above:
+            edges.append(((end, bottom), (start, bottom)))
+    return edges
+
+
+def _direction(edge):
+    (x1, y1), (x2, y2) = edge
+    return (x2 > x1) - (x2 < x1), (y2 > y1) - (y2 < y1)
+
+
+def _trace_rings(edges):
+    outgoing = {}
+    for edge in edges:
+        outgoing.setdefault(edge[0], []).append(edge)
+
+    rings = []
+    for first in edges:
+        start, end = first
+        if first not in outgoing.get(start, ()):
+            continue  # Already used
+        outgoing[start].remove(first)
+        ring = [start]
+        dx, dy = _direction(first)
+        while end != start:
+            ring.append(end)
+            candidates = outgoing[end]
+            if len(candidates) == 1:
+                edge = candidates.pop()
+            else:
+                # Pinch point between two diagonally touching regions.
+                # Turning towards the interior keeps each region in its own ring.
+                edge = max(
+                    candidates,
+                    key=lambda e: dx * _direction(e)[1] - dy * _direction(e)[0]
+                )
+                candidates.remove(edge)
+            dx, dy = _direction(edge)
+            end = edge[1]
+        rings.append(_drop_collinear(ring))
+    return rings
+
+
+def _drop_collinear(ring):
+    result = []
+    n = len(ring)
+    for i in range(n):
+        prev_x, prev_y = ring[i - 1]
+        x, y = ring[i]
+        next_x, next_y = ring[(i + 1) % n]
+        if not (prev_x == x == next_x or prev_y == y == next_y):
+            result.append((x, y))
+    return result
+
+
+def outline(slabs):
+    """Traces the rings around a list of contiguous (y0, y1, intervals) slabs"""
+    return _trace_rings(_boundary_edges(slabs))
+
+
+def _boolean(a, b, op):
+    return outline(_boolean_slabs(a, b, op))
+
+
+def union(a, b):
+    return _boolean(a, b, operator.or_)
+
+
+def intersection(a, b):
+    return _boolean(a, b, operator.and_)
+
+
+def difference(a, b):
+    return _boolean(a, b, _only_first)
+
+
+def overlaps(a, b):
+    """Whether the two polygons share any area (touching edges do not count)"""
+    return any(intervals for _, _, intervals in _boolean_slabs(a, b, operator.and_))
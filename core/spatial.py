@@ -0,0 +1,102 @@
+"""Spatial indexing for fast hit-testing and region queries
+"""
+
+from math import floor
+
+
+DEFAULT_CELL_SIZE = 16
+
+
+class GridIndex:
+    """Uniform grid spatial hash of objects keyed by their bounding boxes
+
+    Bounding boxes are (minx, miny, maxx, maxy) tuples in world space.
+    Objects are bucketed into every grid cell their bounding box touches,
+    so point queries only need to look at a single bucket.
+    """
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._bounds = {}
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def __contains__(self, obj):
+        return obj in self._bounds
+
+    def __iter__(self):
+        yield from self._bounds
+
+    def _cell_range(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        size = self.cell_size
+        return (
+            range(floor(minx / size), floor(maxx / size) + 1),
+            range(floor(miny / size), floor(maxy / size) + 1),
+        )
+
+    def bounds(self, obj):
+        return self._bounds[obj]
+
+    def insert(self, obj, bounds):
+        if obj in self._bounds:
+            self.remove(obj)
+        self._bounds[obj] = bounds
+        x_range, y_range = self._cell_range(bounds)
+        for cx in x_range:
+            for cy in y_range:
+                # dicts are used as insertion-ordered sets
+                self._cells.setdefault((cx, cy), {})[obj] = None
+
+    def remove(self, obj):
+        bounds = self._bounds.pop(obj, None)
+        if bounds is None:
+            return
+        x_range, y_range = self._cell_range(bounds)
+        for cx in x_range:
+            for cy in y_range:
+                bucket = self._cells.get((cx, cy))
+                if bucket is not None:
+                    bucket.pop(obj, None)
+                    if not bucket:
+                        del self._cells[cx, cy]
+
+    def update(self, obj, bounds):
+        """Insert or move an object. Does nothing if its bounds are unchanged."""
+        if self._bounds.get(obj) != bounds:
+            self.insert(obj, bounds)
+
+    def clear(self):
+        self._cells.clear()
+        self._bounds.clear()
+
+    def query_point(self, point):
+        """Yields each object whose bounding box contains the point (inclusive)"""
+        x, y = point
+        size = self.cell_size
+        bucket = self._cells.get((floor(x / size), floor(y / size)))
+        if not bucket:
+            return
+        for obj in bucket:
+            minx, miny, maxx, maxy = self._bounds[obj]
+            if minx <= x <= maxx and miny <= y <= maxy:
+                yield obj
+
+    def query_rect(self, minx, miny, maxx, maxy):
+        """Yields each object whose bounding box overlaps the rectangle (inclusive)"""
+        x_range, y_range = self._cell_range((minx, miny, maxx, maxy))
+        if len(x_range) * len(y_range) > len(self._cells):
+            # Cheaper to check everything than to walk mostly-empty cells
+            candidates = self._bounds
+        else:
+            candidates = {}
+            for cx in x_range:
+                for cy in y_range:
+                    bucket = self._cells.get((cx, cy))
+                    if bucket:
+                        candidates.update(bucket)
+        for obj in candidates:
+            o_minx, o_miny, o_maxx, o_maxy = self._bounds[obj]
+            if o_minx <= maxx and o_miny <= maxy and o_maxx >= minx and o_maxy >= miny:
+                yield obj
@@ -3,14 +3,17 @@
 
 import functools
 import json
+import math
 import os.path
+import traceback
 
-from PySide2.QtCore import Signal
+from PySide2.QtCore import QLineF, QRectF, Signal
 from PySide2.QtGui import *
 from PySide2.QtWidgets import QFrame, QApplication, QMessageBox
 
 from core.model import Map
 from gui.paintutil import *
+from gui.rendercache import TileCache
 from gui.tools import ToolNotAllowed
 from gui import doors
 
@@ -21,12 +24,56 @@ GRID_BRUSH = QBrush(QColor(120, 185, 200, 100))
 LeftAndRightButtons = Qt.LeftButton | Qt.RightButton
 
 GRID_LINE_THICKNESS = 2
+# Closest (in pixels) grid lines are drawn. Zoomed out further, only every 2nd, 4th, ... is drawn.
+GRID_MIN_SPACING = 6
 WHEEL_DEGREES_PER_2X_ZOOM = 180
 WHEEL_UNITS_PER_2X_ZOOM = 8 * WHEEL_DEGREES_PER_2X_ZOOM
 TOOLBAR_ZOOM_FACTOR = 15 / WHEEL_DEGREES_PER_2X_ZOOM
 
+# Default cap on the total size of the undo history, in characters of serialized changes
+UNDO_MEMORY_BUDGET = 32 * 1024 * 1024
+
+# How far past the visible area (in pixels) an item's label is assumed to be able to reach
+LABEL_CULL_MARGIN = 256
+# How far past their bounds (in pixels) the lines of tool hints may be drawn
+HINT_REPAINT_MARGIN = 2 * WALL_THICKNESS
+
+# Default level of detail: the size (in pixels) a grid cell must be for each kind of
+# detail to be drawn in full. Below 'room', rooms no bigger than that are drawn as plain rects.
+LOD_THRESHOLDS = {
+    'label': 10,
+    'item': 4,
+    'door': 8,
+    'room': 4,
+}
+DOOR_MARK_COLOR = QColor(150, 150, 150)
+
+
+def _grown(rect, margin):
+    """(minx, miny, maxx, maxy) bounds of a QRectF grown by a margin on every side"""
+    return (
+        rect.left() - margin,
+        rect.top() - margin,
+        rect.right() + margin,
+        rect.bottom() + margin,
+    )
+
+
+def _overlaps(bounds, view):
+    minx, miny, maxx, maxy = bounds
+    view_minx, view_miny, view_maxx, view_maxy = view
+    return minx <= view_maxx and miny <= view_maxy and maxx >= view_minx and maxy >= view_miny
+
+
+def _point_in(point, view):
+    x, y = point
+    minx, miny, maxx, maxy = view
+    return minx <= x <= maxx and miny <= y <= maxy
+
 class MapDisplay(QFrame):
     status = Signal(str)
+    # filename, whether only the journal was written, error message (empty if successful)
+    _save_finished = Signal(str, bool, str)
 
     def __init__(self, filename=None):
         super().__init__()
@@ -41,6 +88,10 @@ class MapDisplay(QFrame):
 
         self.model = Map()
         self.current_floor = 0
+        # Rooms, items and doors, rendered ahead of time
+        self.render_cache = TileCache(overdraw=LABEL_CULL_MARGIN)
+        # The render cache must be cleared after changing these
+        self.lod_thresholds = dict(LOD_THRESHOLDS)
 
         self.pan_anchor = None
 
@@ -50,22 +101,36 @@ class MapDisplay(QFrame):
         self.selection = None
 
         self.filename = None
+        self._journal_saves = False
+        self._save_finished.connect(self._report_save)
 
         self.hover_key = None
         self.hover_position = None
 
 
+        # Each entry is (floor index, serialized changes from Floor.take_changes)
         self._undo_history = []
-        self._undo_index = 0
+        self._undo_index = 0  # how many entries of the history are currently applied
+        self._undo_size = 0
+        self.undo_budget = UNDO_MEMORY_BUDGET
+        # (floor index, serialized changes, undo) for each step since the file was last written,
+        # only kept while saves are journaled
+        self._journal_steps = []
+        self._journal_size = 0
+        self._full_save_needed = False
+        # Full saves that haven't finished yet, and how many of those were started before the
+        # journal last had to be dropped (so they don't have everything it was missing)
+        self._full_saves_running = 0
+        self._stale_full_saves = 0
         if filename:
             self.open(filename)
-        else:
-            self._push_model_state()
+        if self.filename is None:
+            # Either nothing to open or it failed to, and the empty map still needs its history
+            self._reset_history()
 
     def pan(self, x, y):
         self.world_to_screen.translate(x, y)
-        self.screen_to_world, _ = self.world_to_screen.inverted()
-        self.update()
+        self._view_changed()
 
     def zoom(self, factor, center=None):
         if center is None:
@@ -77,31 +142,71 @@ class MapDisplay(QFrame):
         self.world_to_screen.translate(cx, cy)
         self.world_to_screen.scale(factor, factor)
         self.world_to_screen.translate(-cx, -cy)
-        self.screen_to_world, _ = self.world_to_screen.inverted()
-        self.update()
+        self._view_changed()
 
     zoom_in = functools.partialmethod(zoom, 2.0 ** TOOLBAR_ZOOM_FACTOR)
     zoom_out = functools.partialmethod(zoom, 2.0 ** -TOOLBAR_ZOOM_FACTOR)
 
-    def paintEvent(self, event):
-        with Painter(self, self.world_to_screen) as p:
-            pixel_size = self.screen_to_world.m11(), self.screen_to_world.m22()
+    def _view_changed(self):
+        # Keeps the world origin on a whole device pixel, so that the cached tiles line up
+        # exactly with what is drawn live on top of them
+        ratio = self.devicePixelRatioF()
+        view = self.world_to_screen
+        self.world_to_screen = QTransform(
+            view.m11(), view.m12(), view.m21(), view.m22(),
+            round(view.dx() * ratio) / ratio, round(view.dy() * ratio) / ratio
+        )
+        self.screen_to_world, _ = self.world_to_screen.inverted()
+        self.update()
 
-            for room in self.model[self.current_floor].rooms():
-                # TODO? Culling
-                p.setPen(QPen(BLACK_BRUSH, self.screen_to_world.m11() * WALL_THICKNESS))
-                p.setBrush(room.color)
-                p.drawPath(room.get_path())
-
-                for item in room.items:
-                    if item.icon:
-                        pass  # TODO
-                    else:
-                        fill_circle(p, item.position, 0.3)
+    def _draw_floor(self, floor, p, visible):
+        """Draws the rooms, items and doors that overlap the visible world-space rect
+
+        Details too small to make out at the current zoom are simplified or
+        left out, according to `lod_thresholds`.
+        """
+        scale = p.worldTransform().m11()
+        pixel_size = 1 / scale, 1 / scale
+        lod = self.lod_thresholds
+        draw_items = scale >= lod['item']
+        draw_labels = scale >= lod['label']
+        min_room_size = lod['room'] * pixel_size[0]
+        view = _grown(visible, pixel_size[0] * WALL_THICKNESS)
+        if draw_labels:
+            label_view = _grown(visible, pixel_size[0] * LABEL_CULL_MARGIN)
+        else:
+            label_view = view
+
+        wall_pen = QPen(BLACK_BRUSH, pixel_size[0] * WALL_THICKNESS)
+        for room in floor.rooms_in_rect(*label_view):
+            if _overlaps(room.bounding_box, view):
+                minx, miny, maxx, maxy = room.bounding_box
+                if maxx - minx < min_room_size and maxy - miny < min_room_size:
+                    # Not much more than a dot, and this doesn't need the room's shape loaded
+                    p.fillRect(QRectF(minx, miny, maxx - minx, maxy - miny), BLACK_BRUSH)
+                else:
+                    p.setPen(wall_pen)
+                    p.setBrush(QColor(room.color))
+                    p.drawPath(room.get_path())
+
+            if not draw_items:
+                continue
+            for item in room.items:
+                if not (
+                    _point_in(item.position, label_view)
+                    or draw_labels and _point_in(item.label_pos_hint, label_view)
+                ):
+                    continue
+                if item.icon:
+                    pass  # TODO
+                else:
+                    fill_circle(p, item.position, 0.3)
+                if draw_labels:
                     # TODO: adjust label positions if offscreen or intersecting other labels.
                     draw_label(p, item.position, item.label_pos_hint, item.label, pixel_size)
 
-            for door in self.model[self.current_floor].doors():
+        if scale >= lod['door']:
+            for door in floor.doors_in_rect(*view):
                 door_style = doors.BASE_STYLES.get(door.type, doors.DEFAULT_STYLE)
                 door_style.draw(
                     p,
@@ -111,38 +216,88 @@ class MapDisplay(QFrame):
                     door.extent,
                     room_colors=door.colors
                 )
+        else:
+            # Just mark the gap in the wall
+            marks = []
+            for door in floor.doors_in_rect(*view):
+                tangent = door.normal.rotated90cw * door.extent
+                marks.append(QLineF(
+                    QPointF(*(door.position - tangent)),
+                    QPointF(*(door.position + tangent))
+                ))
+            p.setPen(QPen(DOOR_MARK_COLOR, pixel_size[0] * WALL_THICKNESS))
+            p.drawLines(marks)
+
+    def paintEvent(self, event):
+        floor = self.model[self.current_floor]
+        self.render_cache.invalidate(floor, floor.take_damage())
+        with Painter(self) as p:
+            # The map itself comes from the cache. Only hints and the grid are drawn live.
+            self.render_cache.draw(
+                p,
+                floor,
+                self.world_to_screen,
+                event.rect(),
+                functools.partial(self._draw_floor, floor),
+                self.devicePixelRatioF()
+            )
+            p.setWorldTransform(self.world_to_screen)
+            pixel_size = self.screen_to_world.m11(), self.screen_to_world.m22()
+            visible = self.screen_to_world.mapRect(QRectF(event.rect()))
 
             if self.edit_state:
                 self.edit_state.draw_hint(p, pixel_size)
             elif self.hover_key:
                 self.current_tool.draw_hover_hint(
                     p,
-                    self.model[self.current_floor],
+                    floor,
                     self.hover_position,
                     pixel_size,
                     QApplication.keyboardModifiers()
                 )
 
-            # Draw grid lines
-            visible = self.screen_to_world.mapRect(event.rect())
-            top = int(visible.top() - 1)
-            bottom = int(visible.bottom() + 2)
-            left = int(visible.left() - 1)
-            right = int(visible.right() + 2)
-
-            # Vertical Lines
-            p.setPen(QPen(GRID_BRUSH, pixel_size[0] * GRID_LINE_THICKNESS))
-            for x in range(left, right):
-                p.drawLine(x, top, x, bottom)
-
-            # Horizontal Lines
-            p.setPen(QPen(GRID_BRUSH, pixel_size[1] * GRID_LINE_THICKNESS))
-            for y in range(top, bottom):
-                p.drawLine(left, y, right, y)
+            self._draw_grid(p, visible, pixel_size)
 
             p.setWorldMatrixEnabled(False)
             self.drawFrame(p)
 
+    def _draw_grid(self, p, visible, pixel_size):
+        """Draws the grid lines crossing the visible world-space rect
+
+        Lines are only drawn at multiples of the smallest power of 2 that
+        keeps them `GRID_MIN_SPACING` pixels apart. Every other one of those
+        fades in as the spacing grows towards twice that, so that no lines
+        pop in or out while zooming.
+        """
+        spacing = 1 / pixel_size[0]
+        step = 1
+        while step * spacing < GRID_MIN_SPACING:
+            step *= 2
+        fade = min(step * spacing / GRID_MIN_SPACING - 1, 1)
+
+        # Lines just outside the rect can still reach into it by half their width
+        width = pixel_size[0] * GRID_LINE_THICKNESS
+        left = math.floor((visible.left() - width) / step) * step
+        top = math.floor((visible.top() - width) / step) * step
+        right = visible.right() + width + step
+        bottom = visible.bottom() + width + step
+        major = []
+        minor = []
+        for x in range(left, math.ceil(right), step):
+            (minor if x % (2 * step) else major).append(QLineF(x, top, x, bottom))
+        for y in range(top, math.ceil(bottom), step):
+            (minor if y % (2 * step) else major).append(QLineF(left, y, right, y))
+
+        if fade == 1:
+            major += minor
+        elif fade > 0:
+            color = GRID_BRUSH.color()
+            color.setAlphaF(color.alphaF() * fade)
+            p.setPen(QPen(color, width))
+            p.drawLines(minor)
+        p.setPen(QPen(GRID_BRUSH, width))
+        p.drawLines(major)
+
     def mousePressEvent(self, event):
         if self.edit_continued:
             return
@@ -155,6 +310,7 @@ class MapDisplay(QFrame):
         elif self.has_context_menu and button & Qt.RightButton:
             return  # Will context menu on release
         elif button & LeftAndRightButtons:
+            last_hint = self._hint_bounds()
             if button & LeftAndRightButtons == LeftAndRightButtons:
                 self.edit_state = None
             else:
@@ -167,6 +323,8 @@ class MapDisplay(QFrame):
                     )
                 except ToolNotAllowed as nope:
                     self.status.emit(str(nope))
+            self._update_world(*last_hint, *self._hint_bounds())
+            return
         else:
             return  # early return to avoid update/repaint
         self.update()
@@ -181,12 +339,14 @@ class MapDisplay(QFrame):
             self.pan(diff.x(), diff.y())
 
         if self.edit_state:
+            last_hint = self._hint_bounds()
             if self.edit_state.update(
                 self.screen_to_world.map(event.localPos()),
                 QApplication.keyboardModifiers()
             ):
-                self.update()
+                self._update_world(*last_hint, *self._hint_bounds())
         elif hasattr(self.current_tool, 'hover'):
+            last_hint = self._hint_bounds()
             self.hover_position = self.screen_to_world.map(event.localPos())
             last_hover_key = self.hover_key
             self.hover_key = self.current_tool.hover(
@@ -195,7 +355,7 @@ class MapDisplay(QFrame):
                 QApplication.keyboardModifiers()
             )
             if last_hover_key != self.hover_key:
-                self.update()
+                self._update_world(*last_hint, *self._hint_bounds())
 
     def mouseReleaseEvent(self, event):
         if self.edit_continued:
@@ -232,8 +392,9 @@ class MapDisplay(QFrame):
             and self.edit_state
             and event.key() in (Qt.Key_Shift, Qt.Key_Control, Qt.Key_Alt)
         ):
+            last_hint = self._hint_bounds()
             self.edit_state.update_modifiers(QApplication.queryKeyboardModifiers())
-            self.update()
+            self._update_world(*last_hint, *self._hint_bounds())
         else:
             super().keyPressEvent(event)
 
@@ -243,8 +404,9 @@ class MapDisplay(QFrame):
             and self.edit_state
             and event.key() in (Qt.Key_Shift, Qt.Key_Control, Qt.Key_Alt)
         ):
+            last_hint = self._hint_bounds()
             self.edit_state.update_modifiers(QApplication.queryKeyboardModifiers())
-            self.update()
+            self._update_world(*last_hint, *self._hint_bounds())
         else:
             super().keyReleaseEvent(event)
 
@@ -253,6 +415,40 @@ class MapDisplay(QFrame):
         zoom_pow = sign * event.angleDelta().y() / (8 * WHEEL_DEGREES_PER_2X_ZOOM)
         self.zoom(2.0 ** zoom_pow, (event.pos()))
 
+    def _hint_bounds(self):
+        """World-space bounds of the tool hint currently drawn, for `_update_world`
+
+        Empty if no hint is drawn, or (None,) if its bounds aren't known.
+        """
+        if self.edit_state:
+            if hasattr(self.edit_state, 'hint_bounds'):
+                return (self.edit_state.hint_bounds(),)
+            return (None,)
+        if self.hover_key:
+            if hasattr(self.current_tool, 'hover_hint_bounds'):
+                return (self.current_tool.hover_hint_bounds(
+                    self.model[self.current_floor],
+                    self.hover_position,
+                    QApplication.keyboardModifiers()
+                ),)
+            return (None,)
+        return ()
+
+    def _update_world(self, *bounds):
+        """Repaints the screen area covered by each (minx, miny, maxx, maxy) in world space
+
+        Repaints everything if any of them is None.
+        """
+        if None in bounds:
+            self.update()
+            return
+        for minx, miny, maxx, maxy in bounds:
+            rect = self.world_to_screen.mapRect(QRectF(minx, miny, maxx - minx, maxy - miny))
+            self.update(rect.adjusted(
+                -HINT_REPAINT_MARGIN, -HINT_REPAINT_MARGIN,
+                HINT_REPAINT_MARGIN, HINT_REPAINT_MARGIN
+            ).toAlignedRect())
+
     # -- misc. signal receivers --
 
     @property
@@ -279,33 +475,114 @@ class MapDisplay(QFrame):
         )
 
     def set_tool(self, button):
+        # The hint of the last tool has to go, and its hover hint can't be drawn by the new one
+        last_hint = self._hint_bounds()
         self.current_tool = button.tool
         self.edit_state = None
         self.edit_continued = None
         self.selection = None
+        self.hover_key = None
+        self._update_world(*last_hint)
         if hasattr(self.current_tool, 'cursor'):
             self.setCursor(QCursor(self.current_tool.cursor))
         else:
             self.setCursor(QCursor(Qt.ArrowCursor))
         self.setMouseTracking(hasattr(self.current_tool, 'hover'))
 
-    def save(self, filename=None):
+    @property
+    def journal_saves(self):
+        """Whether saves only write the changes since the last full save, to a journal"""
+        return self._journal_saves
+
+    @journal_saves.setter
+    def journal_saves(self, enabled):
+        if enabled == self._journal_saves:
+            return
+        self._journal_saves = enabled
+        if enabled:
+            # Nothing was recorded while it was off
+            self._drop_journal()
+        else:
+            self._journal_steps = []
+            self._journal_size = 0
+
+    def _drop_journal(self):
+        """Forgets the recorded steps and makes the next save write the whole file"""
+        self._journal_steps = []
+        self._journal_size = 0
+        self._full_save_needed = True
+        self._stale_full_saves = self._full_saves_running
+
+    def _record_journal_step(self, floor, changes, undo):
+        if not self._journal_saves:
+            return
+        self._journal_steps.append((floor, changes, undo))
+        self._journal_size += len(changes)
+        if self._journal_size > self.undo_budget:
+            self._drop_journal()  # A full save is cheaper than keeping all of that around
+
+    def save(self, filename=None, format=None):
+        """Saves in the background. The outcome is reported through `status`."""
         if filename is None:
             filename = self.filename
         if filename is None:
             raise Exception(f"Filename {filename} does not exist!")
+        journal = (
+            self.journal_saves
+            and filename == self.filename
+            and format is None
+            and not self._full_save_needed
+        )
         try:
-            self.model.save(filename)
+            if journal:
+                steps = [
+                    (floor, json.loads(changes), undo)
+                    for floor, changes, undo in self._journal_steps
+                ]
+                future = self.model.save_journal(filename, steps, wait=False)
+            else:
+                future = self.model.save(filename, format, wait=False)
         except Exception:
             traceback.print_exc()
-            self.status.emit
+            self.status.emit(f"Unable to save '{filename}'")
+            return
+        self.filename = filename
+        self._journal_steps = []
+        self._journal_size = 0
+        if not journal:
+            self._full_saves_running += 1
+        self.status.emit(f"Saving '{filename}'...")
+
+        def finished(future):
+            error = future.exception()
+            if error is not None:
+                traceback.print_exception(type(error), error, error.__traceback__)
+            self._save_finished.emit(filename, journal, str(error) if error is not None else '')
+
+        future.add_done_callback(finished)
+
+    def _report_save(self, filename, journal, error):
+        stale = False
+        if not journal:
+            # Saves finish in the order they were started
+            self._full_saves_running -= 1
+            if self._stale_full_saves:
+                self._stale_full_saves -= 1
+                stale = True
+        if error:
+            # What the failed save would have contained has to be written out in full next time
+            self._full_save_needed = True
+            self.status.emit(f"Unable to save '{filename}': {error}")
         else:
-            self.filename = filename
+            if not journal and not stale:
+                # The file now has everything, including whatever a failed save didn't write
+                self._full_save_needed = False
             self.status.emit(f"Saved '{filename}'")
 
     def open(self, filename):
         try:
             self.model = Map.load(filename)
+            self.render_cache.clear()
         except Exception:
             traceback.print_exc()
             self.status.emit(f"Unable to open '{filename}'")
@@ -313,38 +590,57 @@ class MapDisplay(QFrame):
             self.filename = filename
             self.update()
             self.status.emit(f"Opened '{filename}'")
-            self._push_model_state()
+            self._reset_history()
 
     def new(self):
         # TODO: Tabs
         answer = QMessageBox.question(self, "Confirm New Map...", "Are you sure?")
         if answer == QMessageBox.Yes:
             self.model = Map()
-            self._push_model_state()
+            self.render_cache.clear()
+            self._reset_history()
+            self.update()
 
     def undo(self):
         if self._undo_index > 0:
             self._undo_index -= 1
-            filename, floor, state = self._undo_history[self._undo_index]
-            self.model = Map.from_json(json.loads(state))
-            self.filename = filename
+            floor, changes = self._undo_history[self._undo_index]
+            self.model[floor].apply_changes(json.loads(changes), undo=True)
+            self._record_journal_step(floor, changes, True)
             self.current_floor = floor
             self.update()
 
     def redo(self):
-        if self._undo_index < len(self._undo_history) - 1:
+        if self._undo_index < len(self._undo_history):
+            floor, changes = self._undo_history[self._undo_index]
+            self.model[floor].apply_changes(json.loads(changes))
+            self._record_journal_step(floor, changes, False)
             self._undo_index += 1
-            filename, floor, state = self._undo_history[self._undo_index]
-            self.model = Map.from_json(json.loads(state))
-            self.filename = filename
             self.current_floor = floor
             self.update()
 
+    def _reset_history(self):
+        self._undo_history = []
+        self._undo_index = 0
+        self._undo_size = 0
+        self._journal_steps = []
+        self._journal_size = 0
+        self._full_save_needed = False
+        self.model.track_changes()
+
     def _push_model_state(self):
-        # Quick and dirty solution - save the map as a json string at each step
-        del self._undo_history[self._undo_index + 1:]
-        state = json.dumps(self.model.to_json())
-        self._undo_history.append(
-            (self.filename, self.current_floor, state)
-        )
-        self._undo_index = len(self._undo_history) - 1
+        """Records what the last edit changed as an undo step"""
+        changes = self.model[self.current_floor].take_changes()
+        if changes is None:
+            return
+        for _, dropped in self._undo_history[self._undo_index:]:
+            self._undo_size -= len(dropped)
+        del self._undo_history[self._undo_index:]
+        state = json.dumps(changes)
+        self._undo_history.append((self.current_floor, state))
+        self._record_journal_step(self.current_floor, state, False)
+        self._undo_size += len(state)
+        while self._undo_size > self.undo_budget and len(self._undo_history) > 1:
+            _, dropped = self._undo_history.pop(0)
+            self._undo_size -= len(dropped)
+        self._undo_index = len(self._undo_history)
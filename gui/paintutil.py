@@ -152,7 +152,7 @@ class DoorStyle:
         if self.is_open:
             gradient = QLinearGradient(*transform(0, -1), *transform(0, 1))
             for i, color in enumerate(room_colors):
-                gradient.setColorAt(i, color.lighter(100 + highlight))
+                gradient.setColorAt(i, QColor(color).lighter(100 + highlight))
             path = QPainterPath()
             path.moveTo(*transform(-1, -1))
             path.lineTo(*transform(-1, 1))
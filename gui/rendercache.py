@@ -0,0 +1,143 @@
+"""Cache of pre-rendered tiles of the parts of the map that don't change while hovering or panning
+"""
+
+import math
+from collections import OrderedDict
+
+from PySide2.QtCore import QPointF, QRectF, Qt
+from PySide2.QtGui import QPainter, QPixmap, QTransform
+
+
+TILE_SIZE = 256  # device pixels, at most
+# Default cap on the memory used by cached tiles, in bytes
+RENDER_CACHE_BUDGET = 64 * 1024 * 1024
+
+
+class TileCache:
+    """Rendered tiles keyed by (floor, zoom, device pixel ratio, tile x, tile y)
+
+    Tiles are aligned to the world origin in device pixels at each zoom
+    level, so panning reuses them and zooming back to a previous level
+    finds the tiles from before. Tiles are a whole number of both device
+    and logical pixels across where the device pixel ratio allows, so they
+    always start on a whole pixel and text, which Qt places on logical
+    pixels, doesn't shift where a label crosses from one tile to the next.
+    The least recently drawn tiles are dropped once the total exceeds the
+    memory budget.
+    """
+    def __init__(self, budget=RENDER_CACHE_BUDGET, tile_size=TILE_SIZE, overdraw=0):
+        self.budget = budget
+        self.tile_size = tile_size
+        # How far (in pixels) drawing may reach past the bounds of what is being drawn
+        self.overdraw = overdraw
+        self._tiles = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def clear(self):
+        self._tiles.clear()
+        self._size = 0
+
+    def _drop(self, key):
+        pixmap = self._tiles.pop(key)
+        self._size -= _pixmap_bytes(pixmap)
+
+    def _tile_sizes(self, device_pixel_ratio):
+        """The (logical, device) size in pixels of the tiles drawn at a device pixel ratio"""
+        logical = max(1, math.floor(self.tile_size / device_pixel_ratio))
+        for size in range(logical, max(0, logical - 64), -1):
+            device = size * device_pixel_ratio
+            if abs(device - round(device)) < 1e-6:
+                return size, round(device)
+        return logical, round(logical * device_pixel_ratio)
+
+    def _tile_rect(self, scale, device_pixel_ratio, tx, ty):
+        """The world-space rect covered by a tile"""
+        size = self._tile_sizes(device_pixel_ratio)[0] / scale
+        return QRectF(tx * size, ty * size, size, size)
+
+    def invalidate(self, floor, damage=None):
+        """Drops tiles of the floor that overlap any of the (minx, miny, maxx, maxy) bounds
+
+        Drops every tile of the floor if damage is None.
+        """
+        if damage is not None and not damage:
+            return
+        for key in list(self._tiles):
+            key_floor, scale, device_pixel_ratio, tx, ty = key
+            if key_floor is not floor:
+                continue
+            if damage is not None:
+                margin = self.overdraw / scale
+                rect = self._tile_rect(scale, device_pixel_ratio, tx, ty)
+                left = rect.left() - margin
+                top = rect.top() - margin
+                right = rect.right() + margin
+                bottom = rect.bottom() + margin
+                if not any(
+                    minx <= right and miny <= bottom and maxx >= left and maxy >= top
+                    for minx, miny, maxx, maxy in damage
+                ):
+                    continue
+            self._drop(key)
+
+    def draw(self, painter, floor, transform, rect, draw_tile, device_pixel_ratio=1):
+        """Draws the tiles covering a screen rect, rendering any that are missing
+
+        `transform` maps world space to the screen, and may only scale
+        (uniformly) and translate. Its translation should be in whole
+        device pixels, or the tiles will be off from what is drawn live by
+        up to half a pixel. `draw_tile(painter, world_rect)` draws the
+        content of a tile onto a painter that is already set up to map
+        world space onto the tile.
+        """
+        # Rounded so that zooming in and back out again finds the same tiles
+        scale = round(transform.m11(), 6)
+        ratio = device_pixel_ratio
+        size = self._tile_sizes(ratio)[1]
+        # Where the world origin is, in device pixels
+        dx = round(transform.dx() * ratio)
+        dy = round(transform.dy() * ratio)
+        for ty in range(
+            math.floor((rect.top() * ratio - dy) / size),
+            math.floor(((rect.bottom() + 1) * ratio - dy) / size) + 1
+        ):
+            for tx in range(
+                math.floor((rect.left() * ratio - dx) / size),
+                math.floor(((rect.right() + 1) * ratio - dx) / size) + 1
+            ):
+                pixmap = self._tile(floor, scale, ratio, tx, ty, draw_tile)
+                painter.drawPixmap(
+                    QPointF((tx * size + dx) / ratio, (ty * size + dy) / ratio), pixmap
+                )
+
+    def _tile(self, floor, scale, device_pixel_ratio, tx, ty, draw_tile):
+        key = (floor, scale, device_pixel_ratio, tx, ty)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+
+        logical_size, size = self._tile_sizes(device_pixel_ratio)
+        pixmap = QPixmap(size, size)
+        pixmap.setDevicePixelRatio(device_pixel_ratio)
+        pixmap.fill(Qt.transparent)
+        painter = QPainter(pixmap)
+        # The painter works in logical pixels, like the widget's
+        painter.setWorldTransform(
+            QTransform().translate(-tx * logical_size, -ty * logical_size).scale(scale, scale)
+        )
+        draw_tile(painter, self._tile_rect(scale, device_pixel_ratio, tx, ty))
+        painter.end()
+
+        self._tiles[key] = pixmap
+        self._size += _pixmap_bytes(pixmap)
+        while self._size > self.budget and len(self._tiles) > 1:
+            self._drop(next(iter(self._tiles)))
+        return pixmap
+
+
+def _pixmap_bytes(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
@@ -7,6 +7,13 @@ update(position, modifiers) - when dragging or changing which modifier keys are
 finish(widget, position, modifiers) - when releasing the mouse. should edit the model
 update_modifiers(modifiers) - when toggling modifier keys
 draw_hint(painter, pixel_size) - draw current state hint
+hint_bounds() - (optional) world-space (minx, miny, maxx, maxy) that draw_hint covers
+
+Tools that show a hint while hovering also have these classmethods:
+
+hover(model, position, modifiers) - a key that changes whenever the hover hint should
+draw_hover_hint(painter, model, position, pixel_size, modifiers) - draw the hover hint
+hover_hint_bounds(model, position, modifiers) - (optional) like hint_bounds, for the hover hint
 
 `position` is a QPoint position of the mouse in world coordinates
 `model` is a Floor
@@ -15,7 +22,10 @@ draw_hint(painter, pixel_size) - draw current state hint
 `painter` is the active painter for drawing
 `pixel_size` is the editor's current (width, height) of a single pixel
 
-update(...) should return True if a repaint is needed
+update(...) should return True if a repaint is needed. Only the area that
+hint_bounds() covered before and after the update is repainted, which is
+why the bounds need not account for the width of lines drawn in pixels.
+Without hint_bounds(), the whole editor is repainted.
 
 """
 
@@ -28,7 +38,7 @@ from PySide2.QtGui import *
 from PySide2.QtWidgets import *
 
 from core.geometry import Path, Point, Vector2, Orientation
-from core.model import Room, Item
+from core.model import Room, Item, DEFAULT_ROOM_COLOR
 from gui import doors
 from gui.paintutil import draw_label, fill_circle, LABEL_SIZE
 
@@ -121,7 +131,7 @@ class LabelEditor(QTextEdit):  # Maybe QLineEdit instead?
 
 
 class _ShapeTool:
-    new_room_color = Qt.white
+    new_room_color = DEFAULT_ROOM_COLOR
 
     def finish(self, widget, position, modifiers=0):
         self.update(position, modifiers)
@@ -160,6 +170,9 @@ class _ShapeTool:
             QPen(self.hint_color, pixel_size[0] * 2)
         )
 
+    def hint_bounds(self):
+        return self.shape.bounding_box
+
     @property
     def hint_color(self):
         if self.erase:
@@ -188,9 +201,10 @@ class RectTool(_ShapeTool):
         self.update_modifiers(modifiers)
 
     def update(self, position, modifiers=0):
+        last_bounds = self.hint_bounds()
         self.p2 = Point(*position.toTuple())
-        self.update_modifiers(modifiers)
-        return True  # TODO: optimize for grid by returning False sometimes
+        # Snapped to the grid, most mouse movements don't change the rect
+        return self.update_modifiers(modifiers) or self.hint_bounds() != last_bounds
 
     @property
     def shape(self):
@@ -326,6 +340,11 @@ class PencilTool(_ShapeTool):
         self.cells[int(x), int(y)] = True
         self.update_modifiers(modifiers)
 
+    def hint_bounds(self):
+        all_x = [x for x, _ in self.cells]
+        all_y = [y for _, y in self.cells]
+        return min(all_x), min(all_y), max(all_x) + 1, max(all_y) + 1
+
 
 class SelectTool:
     icon = _icon('select.svg')
@@ -351,9 +370,15 @@ class SelectTool:
     def context_menu(cls, widget, model, world_pos, widget_pos):
         point = Point(*world_pos.toTuple())
         room = model.room_at(point)
-        item = room.item_at(point)
+        item = room and room.item_at(point)
         if item:
-            cls._item_menu(widget, room, item, widget.mapToGlobal(QPoint(*widget_pos.toTuple())))
+            cls._item_menu(
+                widget,
+                model,
+                room,
+                item,
+                widget.mapToGlobal(QPoint(*widget_pos.toTuple()))
+            )
             return
         door = model.door_at(point)
         if door:
@@ -364,13 +389,15 @@ class SelectTool:
             return
 
     @classmethod
-    def _item_menu(cls, widget, room, item, popup_position):
+    def _item_menu(cls, widget, model, room, item, popup_position):
         def _change_label():
             new_label, valid = QInputDialog.getText(widget, "Item Label", 'Label')
             if valid:
+                model.touch(room)
                 item.label = new_label
                 widget.on_changed()
         def _remove():
+            model.touch(room)
             room.remove_item(item)
             widget.on_changed()
         menu = QMenu(widget)
@@ -381,6 +408,7 @@ class SelectTool:
     @classmethod
     def _door_menu(cls, widget, model, door, popup_position):
         def _change_style():
+            model.touch(door)
             door.type = QInputDialog.getItem(
                 widget,
                 "Select Door Style",
@@ -390,6 +418,7 @@ class SelectTool:
             )
             widget.on_changed()
         def _flip():
+            model.touch(door)
             door.flip()
             widget.on_changed()
         def _remove():
@@ -404,8 +433,11 @@ class SelectTool:
     @classmethod
     def _room_menu(cls, widget, model, room, popup_position):
         def _change_color():
-            room.color = QColorDialog.getColor(room.color, widget, "Select Room Color")
-            widget.on_changed()
+            color = QColorDialog.getColor(QColor(room.color), widget, "Select Room Color")
+            if color.isValid():
+                model.touch(room)
+                room.color = color.name()
+                widget.on_changed()
         def _remove():
             model.remove_room(room)
             widget.on_changed()
@@ -446,7 +478,7 @@ class ItemTool:
     @classmethod
     def hover(cls, model, position, modifiers=0):
         grid_snap = modifiers & Qt.AltModifier == 0
-        if model.room_at(position):
+        if model.room_at(Point(*position.toTuple())):
             return _cell(position.toTuple()) if grid_snap else position
 
     @classmethod
@@ -455,6 +487,13 @@ class ItemTool:
         center = _cell_center(position.toTuple()) if grid_snap else position.toTuple()
         cls.draw_item_hint(painter, center, pixel_size)
 
+    @classmethod
+    def hover_hint_bounds(cls, model, position, modifiers=0):
+        # The marker is either centered in the cell or at the position, depending on grid snap
+        px, py = position.toTuple()
+        x, y = _cell((px, py))
+        return min(x, px) - 0.3, min(y, py) - 0.3, max(x + 1, px) + 0.3, max(y + 1, py) + 0.3
+
     @classmethod
     def draw_item_hint(cls, painter, position, pixel_size):
         fill_circle(painter, position, 0.3, Qt.darkGray)
@@ -466,6 +505,7 @@ class ItemTool:
         if self.target_room is None:
             raise ToolNotAllowed("Items can only be placed inside rooms.")
         # TODO: test for items in the same position
+        self.model = model
         self.item_pos = _cell_center(pos) if grid_snap else pos
         self.label_pos = pos
         self.label_rect = None
@@ -478,6 +518,7 @@ class ItemTool:
     def finish(self, widget, position, modifiers=0):
         self.done = True
         def commit(label):
+            self.model.touch(self.target_room)
             self.target_room.add_item(Item(
                 self.item_pos,
                 label,
@@ -531,6 +572,17 @@ class DoorTool:
             highlight=75
         )
 
+    @classmethod
+    def hover_hint_bounds(cls, model, position, modifiers=0):
+        wall_pos, _ = _wall(position.toTuple())
+        return cls._door_bounds(wall_pos)
+
+    @staticmethod
+    def _door_bounds(wall_pos):
+        """Bounds of a door hint on a wall, which never extends further than half a cell"""
+        x, y = wall_pos
+        return x - 0.5, y - 0.5, x + 0.5, y + 0.5
+
     @classmethod
     def add_toolbar_options(cls, parent):
         style_picker = QComboBox()
@@ -574,6 +626,9 @@ class DoorTool:
             highlight=50
         )
 
+    def hint_bounds(self):
+        return self._door_bounds(self.w1)
+
     @property
     def position(self):
         return (self.w1 + self.w2) * 0.5
@@ -693,4 +748,4 @@ class EditingTools(QToolBar):
         self.new_room_color = new_color
         for tool in self.EDIT_TOOLS:
             if tool:
-                tool.new_room_color = new_color
+                tool.new_room_color = new_color.name()